@@ -0,0 +1,171 @@
+"""
+Benchmarks of the search engines and evaluators on generated instances or
+on a seating file, printed as one JSON object per line so that runs can be
+compared over time.
+
+Every case runs in its own process with fixed seeds, so that timings and
+peak memory (max_rss_kb, which includes the interpreter and instance) are
+not affected by earlier cases.
+"""
+import Queue
+import argparse
+import multiprocessing
+import random
+import resource
+import sys
+import time
+
+import numpy
+import simplejson
+
+from excel_format import read_excel
+from seating import start_seating, create_searcher, NullLogger, SEARCHERS, SquareStateEvaluator, \
+    TablePositionAgnosticClosnessEvaluator, IncrementalSearcher, IncrementalSquareStateEvaluator, \
+    INITIALIZERS, initialize, MoveIndex
+from text_format import read_text
+
+
+def _engines():
+    engines = {name: (lambda name=name: create_searcher(name, NullLogger())) for name in SEARCHERS}
+    engines['incremental'] = lambda: IncrementalSearcher(IncrementalSquareStateEvaluator(), NullLogger())
+    return engines
+
+
+ENGINES = _engines()
+EVALUATORS = ['evaluate', 'delta']
+
+
+def instance(persons, seed, start=None, init='shuffle'):
+    """
+    A seating for persons guests at tables of ten, or read from the start
+    file when given, shuffled or greedily seated as init says.
+    """
+    numpy.random.seed(seed)
+    random.seed(seed)
+    if start is None:
+        state = start_seating(persons=persons, positions=max(1, persons // 10))
+    elif start.endswith('.xls') or start.endswith('.xlsx'):
+        state = read_excel(open(start, 'rb').read())
+    else:
+        state = read_text(open(start))
+    initialize(state, init)
+    return state
+
+
+def bench_engine(name, state, steps, seconds, target):
+    """
+    Steps per second over one search of steps steps, then the energy after
+    searching for seconds and the time until the energy first went below
+    target times the initial energy.
+    """
+    evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    searcher = ENGINES[name]()
+    initial_energy = evaluator.evaluate(state)
+
+    started = time.time()
+    result, _ = searcher.search(state, steps)
+    elapsed = time.time() - started
+
+    time_to_target = None
+    current = state
+    started = time.time()
+    while time.time() - started < seconds:
+        current, _ = searcher.search(current, steps)
+        if time_to_target is None and evaluator.evaluate(current) <= target * initial_energy:
+            time_to_target = time.time() - started
+
+    return {
+        "steps": steps,
+        "steps_per_second": steps / elapsed,
+        "initial_energy": int(initial_energy),
+        "energy_after_steps": int(evaluator.evaluate(result)),
+        "seconds": seconds,
+        "energy_after_seconds": int(evaluator.evaluate(current)),
+        "target": target,
+        "time_to_target": time_to_target,
+    }
+
+
+def bench_evaluator(name, state, steps, seconds, target):
+    """
+    Full evaluations, or incremental deltas of legal swaps, per second.
+    """
+    if name == 'evaluate':
+        evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+        call = lambda: evaluator.evaluate(state)
+    else:
+        evaluator = IncrementalSquareStateEvaluator()
+        evaluator.evaluate(state)
+        index = MoveIndex(state)
+        call = lambda: evaluator.delta(state, *index.sample())
+
+    calls = 0
+    started = time.time()
+    while calls < steps and (calls == 0 or time.time() - started < seconds):
+        call()
+        calls += 1
+    return {"calls": calls, "calls_per_second": calls / (time.time() - started)}
+
+
+def _run_case(queue, kind, name, persons, seed, start, init, steps, seconds, target):
+    state = instance(persons, seed, start, init)
+    bench = bench_engine if kind == 'engine' else bench_evaluator
+    result = {"kind": kind, "name": name, "persons": state.persons, "seed": seed, "start": start, "init": init}
+    result.update(bench(name, state, steps, seconds, target))
+    result["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(result)
+
+
+def run_case(kind, name, persons, seed, start=None, init='shuffle', steps=100, seconds=10.0, target=0.8):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case,
+                                      args=(queue, kind, name, persons, seed, start, init, steps, seconds, target))
+    process.start()
+    # A case that raises or is killed, say for lack of memory, never puts a
+    # result, so it is recorded as failed instead of waited for
+    result = None
+    while result is None and process.is_alive():
+        try:
+            result = queue.get(timeout=1.0)
+        except Queue.Empty:
+            pass
+    if result is None:
+        try:
+            result = queue.get(timeout=1.0)
+        except Queue.Empty:
+            pass
+    process.join()
+    if result is None:
+        result = {"kind": kind, "name": name, "persons": persons, "seed": seed, "start": start, "init": init,
+                  "exitcode": process.exitcode}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[150, 1000, 10000])
+    parser.add_argument('--start', type=str, help="seating file to use instead of generated sizes")
+    parser.add_argument('--init', choices=INITIALIZERS, default='shuffle')
+    parser.add_argument('--engines', nargs='*', choices=sorted(ENGINES), default=sorted(ENGINES))
+    parser.add_argument('--evaluators', nargs='*', choices=EVALUATORS, default=EVALUATORS)
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--target', type=float, default=0.8)
+    parser.add_argument('--output', type=argparse.FileType('a'), default=sys.stdout)
+    args = parser.parse_args()
+
+    sizes = [None] if args.start else args.sizes
+    cases = [('engine', name) for name in args.engines] + [('evaluator', name) for name in args.evaluators]
+    for persons in sizes:
+        for seed in args.seeds:
+            for kind, name in cases:
+                result = run_case(kind, name, persons, seed, args.start, args.init, args.steps, args.seconds,
+                                  args.target)
+                result["time"] = time.time()
+                args.output.write(simplejson.dumps(result, sort_keys=True) + "\n")
+                args.output.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Checkpoints of the master's current state, its energy and version, in the
+binary wire form, so that a long search can be resumed after a crash.
+
+A checkpoint is written to a temporary file next to the target and renamed
+over it, so the target always holds a complete checkpoint.
+"""
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from searchresult import SearchResult
+from wire import StaticRegistry
+
+MAGIC = 'SCKP'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sBQI')
+
+
+def save_checkpoint(filename, state, energy, version, registry=None):
+    """
+    @type state: seating.State
+    @type registry: wire.StaticRegistry
+    """
+    registry = registry if registry is not None else StaticRegistry()
+    static = registry.blob(registry.register(state))
+    data = SearchResult(state, energy).to_bytes(registry)
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.checkpoint', delete=False) as f:
+        try:
+            f.write(_HEADER.pack(MAGIC, VERSION, version, len(static)))
+            f.write(static)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        except:
+            os.unlink(f.name)
+            raise
+    os.rename(f.name, filename)
+
+
+def load_checkpoint(filename):
+    """
+    The state, energy and version of a checkpoint.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, version, state_version, static_size = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a seating checkpoint: %s" % filename)
+    registry = StaticRegistry()
+    registry.add(data[_HEADER.size:_HEADER.size + static_size])
+    result = SearchResult.from_bytes(data[_HEADER.size + static_size:], registry)
+    return result.state, result.energy, state_version
+
+
+class Checkpointer(object):
+    """
+    Saves the current state of a state keeper when it is asked to and at
+    least interval seconds have passed since the last checkpoint, or the
+    energy has improved by more than the fraction threshold since then.
+    """
+
+    def __init__(self, filename, interval=60.0, threshold=None):
+        self.filename = filename
+        self.interval = interval
+        self.threshold = threshold
+        self.registry = StaticRegistry()
+        self._lock = threading.Lock()
+        self._saved = (None, None, None)
+
+    def update(self, state_keeper, force=False):
+        """
+        @type state_keeper: statekeeper.StateKeeper
+        """
+        with self._lock:
+            saved_time, saved_energy, saved_version = self._saved
+            current, version = state_keeper.get_current_result()
+            if current is None or version == saved_version:
+                return False
+            state, energy = current.state, current.energy
+            if not (force or saved_time is None or
+                    time.time() - saved_time >= self.interval or
+                    self.threshold is not None and energy < saved_energy * (1 - self.threshold)):
+                return False
+            save_checkpoint(self.filename, state, energy, version, self.registry)
+            self._saved = (time.time(), energy, version)
+            return True
@@ -1,21 +1,90 @@
+import os
+import socket
+
 import requests
-from seating import State, TablePositionAgnosticClosnessEvaluator, SingleThreadedSearcher, ClosenessStepper, SquareStateEvaluator, PrintLogger
+import simplejson
+from metrics import METRICS
+from searchresult import SearchResult, plain
+from seating import State, create_searcher
+from statediff import seating_swaps
+from wire import CONTENT_TYPE, RESULT_CONTENT_TYPE, StaticRegistry, UnknownStatic, encode_state, \
+    decode_state, static_id_of
 
 
 class SeatingSlave(object):
-    def __init__(self, addr, port):
+    def __init__(self, addr, port, searcher=None, binary=True, diff=True):
         self.addr = addr
         self.port = port
+        self.searcher = searcher if searcher is not None else create_searcher()
+        self.binary = binary
+        self.diff = diff
+        self.registry = StaticRegistry()
+        self.version = None
+        self.slave_id = '%s:%d' % (socket.gethostname(), os.getpid())
 
     def run(self):
-        evaluator = TablePositionAgnosticClosnessEvaluator()
-        searcher = SingleThreadedSearcher(
-            ClosenessStepper(evaluator),
-            SquareStateEvaluator(evaluator),
-            PrintLogger()
-        )
+        searcher = self.searcher
         while True:
-            response = requests.get('http://%s:%s/get_best_state' % (self.addr, self.port))
-            state = State.from_json(response.content)
-            state, _ = searcher.search(state, n=1000)
-            requests.post('http://%s:%s/report_state' % (self.addr, self.port), data=state.to_json())
\ No newline at end of file
+            base = self.get_best_state()
+            version = self.version
+            state, energy = searcher.search(base, n=1000)
+            if self.diff:
+                self.report_swaps(version, seating_swaps(base, state), energy)
+            else:
+                self.report_result(SearchResult(state, energy))
+
+    def get_best_state(self):
+        headers = self._headers({'Accept': CONTENT_TYPE} if self.binary else {})
+        response = requests.get('http://%s:%s/get_best_state' % (self.addr, self.port), headers=headers)
+        version = response.headers.get('X-State-Version')
+        self.version = int(version) if version is not None else None
+        if response.headers.get('content-type') != CONTENT_TYPE:
+            with METRICS.timer('slave.decode'):
+                return State.from_json(response.content)
+
+        static_id = static_id_of(response.content)
+        if static_id not in self.registry:
+            static = requests.get('http://%s:%s/static/%s' % (self.addr, self.port, static_id.encode('hex')))
+            if static.status_code != 200:
+                raise UnknownStatic(static_id)
+            self.registry.add(static.content)
+        with METRICS.timer('slave.decode'):
+            return decode_state(response.content, self.registry)
+
+    def report_state(self, state):
+        if self.binary:
+            with METRICS.timer('slave.encode'):
+                data = encode_state(state, self.registry)
+            return requests.post('http://%s:%s/report_state' % (self.addr, self.port), data=data,
+                                 headers=self._headers({'Content-Type': CONTENT_TYPE}, metrics=True))
+        with METRICS.timer('slave.encode'):
+            data = state.to_json()
+        return requests.post('http://%s:%s/report_state' % (self.addr, self.port), data=data,
+                             headers=self._headers(metrics=True))
+
+    def report_swaps(self, version, swaps, energy=None):
+        with METRICS.timer('slave.encode'):
+            data = simplejson.dumps({'base_version': version, 'swaps': swaps, 'energy': plain(energy)})
+        return requests.post('http://%s:%s/report_swaps' % (self.addr, self.port), data=data,
+                             headers=self._headers(metrics=True))
+
+    def report_result(self, result):
+        if self.binary:
+            with METRICS.timer('slave.encode'):
+                data = result.to_bytes(self.registry)
+            return requests.post('http://%s:%s/report_result' % (self.addr, self.port), data=data,
+                                 headers=self._headers({'Content-Type': RESULT_CONTENT_TYPE}, metrics=True))
+        with METRICS.timer('slave.encode'):
+            data = result.to_json()
+        return requests.post('http://%s:%s/report_result' % (self.addr, self.port), data=data,
+                             headers=self._headers(metrics=True))
+
+    def _headers(self, headers=None, metrics=False):
+        """
+        headers with the id of this slave, and its metrics for reports.
+        """
+        headers = dict(headers or {})
+        headers['X-Slave-Id'] = self.slave_id
+        if metrics:
+            headers['X-Slave-Metrics'] = simplejson.dumps(METRICS.snapshot())
+        return headers
@@ -0,0 +1,171 @@
+import numpy
+import simplejson
+
+from seating import State
+
+
+class CompactState(object):
+    """
+    Seating stored as the table index of each person at each meal (-1 when
+    absent) plus a boolean membership matrix for the single column groups,
+    instead of the one-hot seating and geometry matrices of State.
+
+    Weights are taken from group_weights, so per person weights are not kept.
+    """
+
+    def __init__(self, names, group_names, group_indexes, group_weights, tables, tables_fixed, groups, groups_fixed):
+        self.names = names
+        self.group_names = group_names
+        self.group_indexes = group_indexes
+        self.group_weights = group_weights
+        self.tables = tables
+        self.tables_fixed = tables_fixed
+        self.groups = groups
+        self.groups_fixed = groups_fixed
+
+        self.meals = [m for m, (i, j) in enumerate(group_indexes) if i + 1 < j]
+        self.single_groups = [m for m, (i, j) in enumerate(group_indexes) if i + 1 == j]
+        self._meal_by_start = {group_indexes[m][0]: k for k, m in enumerate(self.meals)}
+
+    def __eq__(self, other):
+        if type(other) != CompactState:
+            return False
+        return (self.names == other.names and
+                self.group_names == other.group_names and
+                self.group_indexes == other.group_indexes and
+                self.group_weights == other.group_weights and
+                numpy.array_equal(self.tables, other.tables) and
+                numpy.array_equal(self.tables_fixed, other.tables_fixed) and
+                numpy.array_equal(self.groups, other.groups) and
+                numpy.array_equal(self.groups_fixed, other.groups_fixed))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    @property
+    def persons(self):
+        return len(self.names)
+
+    @staticmethod
+    def from_state(state):
+        """
+        @type state: seating.State
+        """
+        meals = [(i, j) for i, j in state.group_indexes if i + 1 < j]
+        single_groups = [i for i, j in state.group_indexes if i + 1 == j]
+
+        tables = numpy.full((state.persons, len(meals)), -1, dtype=numpy.int16)
+        tables_fixed = numpy.zeros((state.persons, len(meals)), dtype=bool)
+        for m, (i, j) in enumerate(meals):
+            seated = state.seating[:, i:j]
+            present = seated.any(axis=1)
+            tables[present, m] = numpy.argmax(seated[present], axis=1)
+            tables_fixed[:, m] = (seated * state.fixed[:, i:j]).any(axis=1)
+
+        groups = state.seating[:, single_groups].astype(bool)
+        groups_fixed = state.fixed[:, single_groups] & groups
+
+        return CompactState(names=state.names,
+                            group_names=state.group_names,
+                            group_indexes=state.group_indexes,
+                            group_weights=state.group_weights,
+                            tables=tables,
+                            tables_fixed=tables_fixed,
+                            groups=groups,
+                            groups_fixed=groups_fixed)
+
+    def to_state(self):
+        columns = self.group_indexes[-1][1] if self.group_indexes else 0
+        seating = numpy.zeros((self.persons, columns), dtype=int)
+        fixed = numpy.zeros((self.persons, columns), dtype=bool)
+
+        for k, m in enumerate(self.meals):
+            i, _ = self.group_indexes[m]
+            persons = numpy.where(self.tables[:, k] >= 0)[0]
+            seating[persons, i + self.tables[persons, k]] = 1
+            fixed[persons, i + self.tables[persons, k]] = self.tables_fixed[persons, k]
+
+        single_columns = [self.group_indexes[m][0] for m in self.single_groups]
+        seating[:, single_columns] = self.groups
+        fixed[:, single_columns] = self.groups_fixed
+
+        return State(names=self.names,
+                     group_names=self.group_names,
+                     group_indexes=self.group_indexes,
+                     group_weights=self.group_weights,
+                     seating=seating,
+                     fixed=fixed,
+                     geometry=seating.copy().transpose())
+
+    @staticmethod
+    def from_json(json):
+        values = simplejson.loads(json)
+        meals = len([(i, j) for i, j in values['group_indexes'] if i + 1 < j])
+        single_groups = len(values['group_indexes']) - meals
+
+        # Explicit shapes, as there may be no meals or no groups
+        def matrix(key, dtype, columns):
+            return numpy.array(values[key], dtype=dtype).reshape(len(values['names']), columns)
+
+        return CompactState(names=values['names'],
+                            group_names=values['group_names'],
+                            group_indexes=values['group_indexes'],
+                            group_weights=values['group_weights'],
+                            tables=matrix('tables', numpy.int16, meals),
+                            tables_fixed=matrix('tables_fixed', bool, meals),
+                            groups=matrix('groups', bool, single_groups),
+                            groups_fixed=matrix('groups_fixed', bool, single_groups))
+
+    def to_json(self):
+        return simplejson.dumps({
+            "names": self.names,
+            "group_names": self.group_names,
+            "group_indexes": self.group_indexes,
+            "group_weights": self.group_weights,
+            "tables": self.tables.tolist(),
+            "tables_fixed": self.tables_fixed.tolist(),
+            "groups": self.groups.tolist(),
+            "groups_fixed": self.groups_fixed.tolist()
+        })
+
+    def copy(self):
+        return CompactState(names=self.names,
+                            group_names=self.group_names,
+                            group_indexes=self.group_indexes,
+                            group_weights=self.group_weights,
+                            tables=self.tables.copy(),
+                            tables_fixed=self.tables_fixed,
+                            groups=self.groups,
+                            groups_fixed=self.groups_fixed)
+
+    def swap(self, i, j, p1, p2):
+        m = self._meal_by_start.get(i)
+        if m is None:
+            return False
+        if self.tables[p1, m] < 0 or self.tables[p2, m] < 0:
+            return False
+        if self.tables_fixed[p1, m] or self.tables_fixed[p2, m]:
+            return False
+        self.tables[p1, m], self.tables[p2, m] = self.tables[p2, m], self.tables[p1, m]
+        return True
+
+    def closeness(self):
+        """
+        Weighted closeness, counted from who shares a table or a group.
+        """
+        result = numpy.zeros((self.persons, self.persons), dtype=int)
+
+        for k, m in enumerate(self.meals):
+            weight = self.group_weights[m]
+            persons = numpy.where(self.tables[:, k] >= 0)[0]
+            order = persons[numpy.argsort(self.tables[persons, k], kind='mergesort')]
+            splits = numpy.where(numpy.diff(self.tables[order, k]))[0] + 1
+            for table in numpy.split(order, splits):
+                result[numpy.ix_(table, table)] += weight
+
+        for k, m in enumerate(self.single_groups):
+            members = numpy.where(self.groups[:, k])[0]
+            result[numpy.ix_(members, members)] += self.group_weights[m]
+
+        numpy.fill_diagonal(result, 0)
+        return result
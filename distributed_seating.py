@@ -1,24 +1,44 @@
 import argparse
+import os
 
+from checkpoint import Checkpointer, load_checkpoint
 from excel_format import read_excel
 from statekeeper import StateKeeper
-from evaluators import HillClimber
+from evaluators import HillClimber, VerificationPolicy
+from metrics import EnergyTrace
 from server import SeatingMaster
 from client import SeatingSlave
-from seating import SquareStateEvaluator, start_seating, TablePositionAgnosticClosnessEvaluator, dump
+from parallel import ParallelSearcher
+from seating import SquareStateEvaluator, start_seating, TablePositionAgnosticClosnessEvaluator, dump, SEARCHERS, \
+    create_searcher, NullLogger, PrintLogger, report, EnergyCache, INITIALIZERS, initialize
 from text_format import read_text
 
 
-def main(start=None, addr=None, port=None, slave=None):
+VERIFICATION_RATES = {'always': 1.0, 'never': 0.0}
+
+
+def main(start=None, addr=None, port=None, slave=None, searcher='greedy', workers=None, iterations=10000,
+         verify='always', verify_rate=0.1, trace=None, checkpoint=None, checkpoint_interval=60.0,
+         checkpoint_threshold=None, resume=False, init='shuffle'):
+    if workers:
+        searcher = ParallelSearcher(create_searcher(searcher, NullLogger()), workers, logger=PrintLogger())
+    else:
+        searcher = create_searcher(searcher)
+
     if slave:
-        client = SeatingSlave(addr, port)
+        client = SeatingSlave(addr, port, searcher)
         client.run()
+    elif resume and checkpoint and os.path.exists(checkpoint):
+        state, energy, version = load_checkpoint(checkpoint)
+        print "Resuming from %s at version %d with energy %s" % (checkpoint, version, energy)
+        _serve(addr, state, energy, version, verify, verify_rate, trace, checkpoint, checkpoint_interval,
+               checkpoint_threshold)
     else:
         if start:
             if start.endswith('.xls') or start.endswith('.xlsx'):
-                state = read_excel(open(start).read())
+                state = read_excel(open(start, 'rb').read())
             elif start.endswith('.txt'):
-                state = read_text(open(start).read())
+                state = read_text(open(start))
             else:
                 raise Exception("Don't know how to open %s" % start)
 
@@ -26,17 +46,33 @@ def main(start=None, addr=None, port=None, slave=None):
             state = start_seating()
 
         print dump(state)
-        state.shuffle()
+        initialize(state, init)
+
+        if workers:
+            # Search locally without a master
+            state, _ = searcher.search(state, n=iterations)
+            print dump(state)
+            print report(state)
+            return
+
+        _serve(addr, state, None, 0, verify, verify_rate, trace, checkpoint, checkpoint_interval,
+               checkpoint_threshold)
+
 
-        state_evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
-        server = SeatingMaster(
-            StateKeeper(
-                HillClimber(state_evaluator),
-                state=state),
-            (addr, 5000),
-            state_evaluator
-        )
-        server.run()
+def _serve(addr, state, energy, version, verify, verify_rate, trace, checkpoint, checkpoint_interval,
+           checkpoint_threshold):
+    # Slaves often send states that have already been scored
+    state_evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator(), EnergyCache())
+    server = SeatingMaster(
+        StateKeeper(
+            HillClimber(state_evaluator, VerificationPolicy(VERIFICATION_RATES.get(verify, verify_rate))),
+            state=state, energy=energy, version=version),
+        (addr, 5000),
+        state_evaluator,
+        trace=EnergyTrace(trace) if trace else None,
+        checkpointer=Checkpointer(checkpoint, checkpoint_interval, checkpoint_threshold) if checkpoint else None
+    )
+    server.run()
 
 
 if __name__ == '__main__':
@@ -45,5 +81,21 @@ if __name__ == '__main__':
     parser.add_argument('--port', type=int, default=5000)
     parser.add_argument('--addr', type=str, default="127.0.0.1")
     parser.add_argument('--slave', action='store_true')
+    parser.add_argument('--searcher', choices=SEARCHERS, default='greedy')
+    parser.add_argument('--init', choices=INITIALIZERS, default='shuffle', help="how to seat the start")
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('-n', '--iterations', type=int, default=10000)
+    parser.add_argument('--verify', choices=['always', 'sampled', 'never'], default='always')
+    parser.add_argument('--verify-rate', type=float, default=0.1)
+    parser.add_argument('--trace', type=str, help="file to append the time and energy of accepted states to")
+    parser.add_argument('--checkpoint', type=str, help="file to save the current state to")
+    parser.add_argument('--checkpoint-interval', type=float, default=60.0,
+                        help="least seconds between checkpoints")
+    parser.add_argument('--checkpoint-threshold', type=float,
+                        help="relative improvement that is checkpointed at once")
+    parser.add_argument('--resume', action='store_true', help="start from the checkpoint if there is one")
     args = parser.parse_args()
-    main(addr=args.addr, port=args.port, slave=args.slave, start=args.start)
+    main(addr=args.addr, port=args.port, slave=args.slave, start=args.start, searcher=args.searcher,
+         workers=args.workers, iterations=args.iterations, verify=args.verify, verify_rate=args.verify_rate,
+         trace=args.trace, checkpoint=args.checkpoint, checkpoint_interval=args.checkpoint_interval,
+         checkpoint_threshold=args.checkpoint_threshold, resume=args.resume, init=args.init)
@@ -1,10 +1,53 @@
+import random
+
+from searchresult import SearchResult
 from statekeeper import StateEvaluator
 
 
+class VerificationPolicy(object):
+    """
+    How often the energy claimed by a search result is checked by
+    evaluating the state: always (rate 1), never (rate 0) or sampled.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+
+    def verify(self):
+        return self.rate >= 1 or random.random() < self.rate
+
+
+ALWAYS = VerificationPolicy(1.0)
+NEVER = VerificationPolicy(0.0)
+
+
 class HillClimber(StateEvaluator):
 
-    def __init__(self, state_evaluator):
+    def __init__(self, state_evaluator, verification=ALWAYS):
         self.state_evaluator = state_evaluator
+        self.verification = verification
 
     def challenge(self, state1, state2):
         return state1 if self.state_evaluator.evaluate(state2) > self.state_evaluator.evaluate(state1) else state2
+
+    def energy(self, result):
+        """
+        The energy of result, evaluated if unknown or picked for verification,
+        or None if the claimed energy turns out to be wrong.
+        """
+        if result.energy is None:
+            return self.state_evaluator.evaluate(result.state)
+        if self.verification.verify():
+            energy = self.state_evaluator.evaluate(result.state)
+            return energy if energy == result.energy else None
+        return result.energy
+
+    def challenge_result(self, result1, result2):
+        """
+        Like challenge, for search results where result1 has a trusted energy.
+        Ties keep result1.
+        """
+        energy = self.energy(result2)
+        if energy is None or energy >= result1.energy:
+            return result1
+        return SearchResult(result2.state, energy)
@@ -1,20 +1,28 @@
+import argparse
 import sys
 from io import BytesIO
 
 import re
 import numpy
-from seating import State, optimize, dump, report, start_seating, stats, fast_search
+from parallel import ParallelSearcher
+from seating import State, optimize, dump, report, start_seating, iter_stats, SEARCHERS, create_searcher, NullLogger, \
+    PrintLogger, INITIALIZERS, initialize, FastSearcher, energy_sum_of_square
 from text_format import read_text, write_text
 from xlrd import open_workbook
-from xlutils.margins import number_of_good_rows, number_of_good_cols
 from bunch import Bunch
+from openpyxl import load_workbook
 from xlwt import Workbook, easyxf
+import xlsxwriter
 
 
 NORMAL = easyxf()
 BOLD = easyxf('font: bold on')
 ROTATED = easyxf('alignment: rotation 90; font: bold on')
 
+# Rows in an .xls and an .xlsx sheet
+XLS_MAX_ROWS = 65536
+XLSX_MAX_ROWS = 1048576
+
 
 class ExcelData(object):
 
@@ -26,27 +34,95 @@ class ExcelData(object):
 
 def read_excel(file_contents):
     """
+    Reads .xls, or .xlsx (a zip file) in read only mode.
+
     @type file_contents: str
     """
     seating = ExcelData()
-    workbook = open_workbook(file_contents=file_contents)
-    for sheet in workbook.sheets():
-        if sheet.name == 'Groups':
-            _read_groups(seating, sheet)
-        elif sheet.name == 'Tables':
-            _read_tables(seating, sheet)
-        elif sheet.name == 'Placement':
-            _read_placement(seating, sheet)
-        elif sheet.name == 'Statistics':
-            continue
-        elif sheet.cell(0, 0).value:
-            _read_placement(seating, sheet)
+    # Statistics are derived from the rest and never even parsed
+    if file_contents[:2] == 'PK':
+        sheets = _xlsx_sheets(file_contents, skip=['Statistics'])
+    else:
+        sheets = _xls_sheets(file_contents, skip=['Statistics'])
+    for name, rows in sheets:
+        if name == 'Groups':
+            _read_groups(seating, rows)
+        elif name == 'Tables':
+            _read_tables(seating, rows)
+        elif name == 'Placement':
+            _read_placement(seating, rows)
+        elif rows and rows[0][0]:
+            _read_placement(seating, rows)
         else:
-            _read_groups(seating, sheet)
+            _read_groups(seating, rows)
 
     return _to_state(seating)
 
 
+def _xls_sheets(file_contents, skip=()):
+    """
+    Names and cell values, row by row, of the sheets of an .xls file, except
+    those named in skip.
+    """
+    workbook = open_workbook(file_contents=file_contents, on_demand=True)
+    for index, name in enumerate(workbook.sheet_names()):
+        if name in skip:
+            continue
+        sheet = workbook.sheet_by_index(index)
+        yield name, [sheet.row_values(row) for row in range(sheet.nrows)]
+        workbook.unload_sheet(index)
+    workbook.release_resources()
+
+
+def _xlsx_sheets(file_contents, skip=()):
+    """
+    Names and cell values, row by row and padded to the same length, of the
+    sheets of an .xlsx file, except those named in skip.
+    """
+    workbook = load_workbook(BytesIO(file_contents), read_only=True, data_only=True)
+    for sheet in workbook.worksheets:
+        if sheet.title in skip:
+            continue
+        rows = [list(row) for row in sheet.iter_rows(values_only=True)]
+        ncols = max([len(row) for row in rows] + [0])
+        yield sheet.title, [row + [None] * (ncols - len(row)) for row in rows]
+    workbook.close()
+
+
+def _junk(value):
+    """
+    Whether a cell counts as empty, like xlutils.margins.cells_all_junk.
+    """
+    if value is None:
+        return True
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, basestring):
+        return not value or value.isspace()
+    return not value
+
+
+def _good_rows(rows, ncols=None):
+    """
+    1 + the index of the last row with data in its first ncols cells.
+    """
+    for row in range(len(rows) - 1, -1, -1):
+        if not all(_junk(value) for value in rows[row][:ncols]):
+            return row + 1
+    return 0
+
+
+def _good_cols(rows, nrows=None):
+    """
+    1 + the index of the last column with data in its first nrows cells.
+    """
+    rows = rows[:nrows]
+    for col in range(max([len(row) for row in rows] + [0]) - 1, -1, -1):
+        if not all(_junk(row[col]) for row in rows):
+            return col + 1
+    return 0
+
+
 def write_excel(state):
     """
     @type state: seating.State
@@ -105,7 +181,8 @@ def write_excel(state):
     statistics.write(0, 1, "Meal closeness", style=BOLD)
     statistics.write(0, 2, "Group closeness", style=BOLD)
 
-    for index, (pair, meal_closeness, group_closeness) in enumerate(stats(state)):
+    # Only the closest pairs fit below the header
+    for index, (pair, meal_closeness, group_closeness) in enumerate(iter_stats(state, limit=XLS_MAX_ROWS - 1)):
         statistics.write(index + 1, 0, pair)
         statistics.write(index + 1, 1, meal_closeness)
         statistics.write(index + 1, 2, group_closeness)
@@ -115,66 +192,113 @@ def write_excel(state):
     return result.getvalue()
 
 
-def _read_groups(excel_data, sheet):
+def write_xlsx(state, out):
+    """
+    Writes the same sheets as write_excel as .xlsx to a file name or a
+    seekable file object, one row at a time so that only the current row of
+    each sheet is held in memory.
+
+    @type state: seating.State
+    """
+    wb = xlsxwriter.Workbook(out, {'constant_memory': True})
+    bold = wb.add_format({'bold': True})
+    rotated = wb.add_format({'bold': True, 'rotation': 90})
+
+    meals = [(group_name, i, j) for group_name, (i, j) in zip(state.group_names, state.group_indexes) if i + 1 < j]
+    seated = numpy.logical_or.reduceat(state.seating.astype(bool), [i for i, _ in state.group_indexes], axis=1)
+
+    groups = wb.add_worksheet('Groups')
+    groups.set_column(0, 0, 27)
+    groups.set_column(1, len(state.group_names), 2)
+    group_names = [group_name + (" (%d)" % weight if weight > 1 else "")
+                   for group_name, weight in zip(state.group_names, state.group_weights)]
+    groups.write_row(0, 1, group_names, rotated)
+    for person, name in enumerate(state.names):
+        groups.write_row(person + 1, 0, [name] + [1 if s else None for s in seated[person]])
+
+    tables = wb.add_worksheet('Tables')
+    tables.set_column(1, max([j - i for _, i, j in meals] + [0]), 4)
+    for row, (group_name, i, j) in enumerate(meals):
+        tables.write(row, 0, group_name, bold)
+        tables.write_row(row, 1, state.seating[:, i:j].sum(axis=0).tolist())
+
+    # One column per meal with the tables below each other, leaving a blank
+    # row after each table, written row by row
+    placement = wb.add_worksheet('Placement')
+    placement.write_row(0, 0, [group_name for group_name, _, _ in meals], bold)
+    cells = []
+    for col, (_, i, j) in enumerate(meals):
+        tables, persons = numpy.nonzero(state.seating[:, i:j].transpose() == 1)
+        rows = 2 + numpy.arange(len(persons)) + tables
+        cells.append((rows, numpy.full(len(persons), col, dtype=int), persons, state.fixed[persons, i + tables]))
+    if cells:
+        rows, cols, persons, fixed = [numpy.concatenate(values) for values in zip(*cells)]
+        for k in numpy.lexsort((cols, rows)):
+            if fixed[k]:
+                placement.write(rows[k], cols[k], "*" + state.names[persons[k]], bold)
+            else:
+                placement.write(rows[k], cols[k], state.names[persons[k]])
+
+    statistics = wb.add_worksheet('Statistics')
+    statistics.write_row(0, 0, ["Pair", "Meal closeness", "Group closeness"], bold)
+    for index, row in enumerate(iter_stats(state, limit=XLSX_MAX_ROWS - 1)):
+        statistics.write_row(index + 1, 0, [row[0], int(row[1]), int(row[2])])
+
+    wb.close()
+
+
+def _read_groups(excel_data, rows):
     """
     @type excel_data: ExcelData
-    @type sheet: xlrd.sheet.Sheet
+    @type rows: list
     """
 
-    names = []
-    for name in sheet.col(0)[1:]:
-        names.append(name.value)
+    names = [row[0] for row in rows[1:]]
 
-    group_names = []
-    for col in range(1, number_of_good_cols(sheet, nrows=1)):
-        group_names.append(sheet.cell(0, col).value)
+    group_names = rows[0][1:_good_cols(rows, nrows=1)] if rows else []
 
+    member_rows = rows[1:_good_rows(rows, ncols=1)]
+    members = numpy.array([row[1:len(group_names) + 1] for row in member_rows],
+                          dtype=object).reshape(len(member_rows), len(group_names)).astype(bool)
     groups_by_group_name = {group_name: [] for group_name in group_names}
-
-    for row in range(1, number_of_good_rows(sheet, ncols=1)):
-        name = sheet.cell(row, 0).value
-        for i, group_name in enumerate(group_names):
-            if sheet.cell(row, i+1).value:
-                groups_by_group_name[group_name].append(name)
+    for col, group_name in enumerate(group_names):
+        groups_by_group_name[group_name].extend(names[row] for row in numpy.flatnonzero(members[:, col]))
 
     excel_data.names = names
     excel_data.groups = [(group_name, groups_by_group_name[group_name]) for group_name in group_names]
 
 
-def _read_tables(excel_data, sheet):
+def _read_tables(excel_data, rows):
     """
     @type excel_data: ExcelData
-    @type sheet: xlrd.sheet.Sheet
+    @type rows: list
     """
 
+    ncols = _good_cols(rows)
     dimensions = []
-    for row in range(0, number_of_good_rows(sheet, ncols=1)):
-        name = sheet.cell(row, 0).value
+    for row in rows[:_good_rows(rows, ncols=1)]:
         sizes = []
-        for col in range(1, number_of_good_cols(sheet)):
-            value = sheet.cell(row, col).value
-            if value:
-                size = int(value)
-            else:
+        for value in row[1:ncols]:
+            if not value:
                 break
-            sizes.append(size)
-        dimensions.append([name, sizes])
+            sizes.append(int(value))
+        dimensions.append([row[0], sizes])
     excel_data.dimensions = dimensions
 
 
-def _read_placement(excel_data, sheet):
+def _read_placement(excel_data, rows):
     """
     @type excel_data: ExcelData
-    @type sheet: xlrd.sheet.Sheet
+    @type rows: list
     """
     placements = []
-    for col in range(number_of_good_cols(sheet)):
-        placement_name = sheet.cell(0, col).value
+    for col in range(_good_cols(rows)):
+        placement_name = rows[0][col]
 
         positions = []
         position = []
-        for cell in sheet.col(col)[1:]:
-            person = cell.value
+        for row in rows[1:]:
+            person = row[col]
             if person:
                 is_fixed = person.startswith('*')
                 if is_fixed:
@@ -251,41 +375,34 @@ def _to_state(excel_data):
 
     if not reset_placement:
         # Fill in positions from placement
-        matrix_col = 0
-        for _, positions in excel_data.placements:
-            for position in positions:
-                for person, is_fixed in position:
-                    matrix_row = person_index_by_name[person]
-                    matrix[matrix_row, matrix_col] = 1
-                    fixed[matrix_row, matrix_col] = is_fixed
-                matrix_col += 1
+        cells = [(person, col, is_fixed)
+                 for col, position in enumerate(position for _, positions in excel_data.placements
+                                                for position in positions)
+                 for person, is_fixed in position]
+        matrix_col = sum(len(positions) for _, positions in excel_data.placements)
+        if cells:
+            persons, cols, is_fixed = zip(*cells)
+            rows = [person_index_by_name[person] for person in persons]
+            matrix[rows, cols] = 1
+            fixed[rows, cols] = is_fixed
     else:
         # Fill in positions in name order
         groups_by_group_name = {group_name: group for group_name, group in excel_data.groups}
+        matrix_col = 0
         for (i, j), (dimension_name, sizes) in zip(group_indexes, excel_data.dimensions):
-            # Traverse names in group with same name (or all persons if there is no such group)
+            # Names in group with same name (or all persons if there is no such group)
             persons = groups_by_group_name.get(dimension_name, names)
-            person_iter = iter(persons)
-            try:
-                for matrix_col, size in zip(range(i, j), sizes):
-                    for _ in range(size):
-                        person = next(person_iter)
-                        matrix_row = person_index_by_name[person]
-                        matrix[matrix_row, matrix_col] = 1
-                        fixed[matrix_row, matrix_col] = False
-                next(person_iter)
+            if len(persons) > sum(sizes):
                 msg = "Not enough places for all %d persons in '%s' to fit in the given tables." % (len(persons), dimension_name)
                 raise Exception(msg)
-            except StopIteration:
-                pass
-        matrix_col = j
+            cols = numpy.repeat(numpy.arange(i, j), sizes)[:len(persons)]
+            matrix[[person_index_by_name[person] for person in persons[:len(cols)]], cols] = 1
+            matrix_col = j
 
     for group_name, group in excel_data.groups:
         if group_name in placement_names:
             continue
-        for name in group:
-            matrix_row = person_index_by_name[name]
-            matrix[matrix_row, matrix_col] = 1
+        matrix[[person_index_by_name[name] for name in group], matrix_col] = 1
         matrix_col += 1
 
     geometry = matrix.copy().transpose()
@@ -299,24 +416,50 @@ def _to_state(excel_data):
                  geometry=geometry)
 
 
+def _searcher(name, logger):
+    """
+    The searcher called name, where 'fast' optimises energy_sum_of_square like
+    fast_search always has here, rather than the energy masters check.
+    """
+    if name == 'fast':
+        return FastSearcher(score=energy_sum_of_square, logger=logger)
+    return create_searcher(name, logger)
+
+
 def main():
-    filename = sys.argv[1] if len(sys.argv) == 2 else "seating.xls"
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', nargs='?', default="seating.xls")
+    parser.add_argument('--searcher', choices=SEARCHERS, default='fast')
+    parser.add_argument('--init', choices=INITIALIZERS, default='shuffle')
+    parser.add_argument('-n', type=int, default=1000)
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    filename = args.filename
     if filename.endswith('.xls') or filename.endswith('.xlsx'):
-        state = read_excel(open(filename).read())
+        state = read_excel(open(filename, 'rb').read())
     elif filename.endswith('.txt'):
-        state = read_text(open(filename).read())
+        state = read_text(open(filename))
     else:
         state = start_seating()
 
-    state.shuffle()
-    state = fast_search(state)
+    initialize(state, args.init)
+    if args.workers:
+        searcher = ParallelSearcher(_searcher(args.searcher, NullLogger()), args.workers, logger=PrintLogger())
+    else:
+        searcher = _searcher(args.searcher, PrintLogger())
+    state, _ = searcher.search(state, n=args.n)
 
     print dump(state)
     print report(state)
     print repr(state)
-    print write_text(state)
-    with open("seating.xls", "wb") as f:
-        f.write(write_excel(state))
+    write_text(state, sys.stdout)
+    if filename.endswith('.xlsx'):
+        with open("seating.xlsx", "wb") as f:
+            write_xlsx(state, f)
+    else:
+        with open("seating.xls", "wb") as f:
+            f.write(write_excel(state))
 
 if __name__ == '__main__':
     main()
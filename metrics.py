@@ -0,0 +1,95 @@
+"""
+Counters and timers for the search loop and the master, and a trace of
+the energy over time.
+"""
+import threading
+import time
+
+
+class Metrics(object):
+    """
+    Named counters and timers, safe to update from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self._counters = {}
+            self._timers = {}
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def add_time(self, name, seconds, n=1):
+        with self._lock:
+            count, total = self._timers.get(name, (0, 0.0))
+            self._timers[name] = (count + n, total + seconds)
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            timers = dict((name, {"count": count, "seconds": total})
+                          for name, (count, total) in self._timers.items())
+            uptime = time.time() - self.started
+        return {"uptime": uptime, "counters": counters, "timers": timers, "rates": rates(counters, timers)}
+
+
+class _Timer(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_time(self.name, time.time() - self.started)
+
+
+def rates(counters, timers):
+    """
+    Steps per second and acceptance rate of the searches, where counted.
+    """
+    result = {}
+    steps = counters.get('search.steps', 0)
+    if steps:
+        result['acceptance_rate'] = float(counters.get('search.accepted', 0)) / steps
+    seconds = timers.get('search', {}).get('seconds')
+    if seconds:
+        result['steps_per_second'] = steps / seconds
+    submissions = counters.get('master.accepted', 0) + counters.get('master.discarded', 0)
+    if submissions:
+        result['submission_acceptance_rate'] = float(counters.get('master.accepted', 0)) / submissions
+    return result
+
+
+METRICS = Metrics()
+
+
+class EnergyTrace(object):
+    """
+    Appends "seconds energy" lines to a file, seconds counted from when the
+    trace was created.
+    """
+
+    def __init__(self, filename):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._file = open(filename, 'a')
+
+    def record(self, energy):
+        with self._lock:
+            self._file.write("%.3f %s\n" % (time.time() - self.started, energy))
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
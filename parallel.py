@@ -0,0 +1,210 @@
+import math
+import multiprocessing
+import os
+import random
+from multiprocessing.sharedctypes import RawArray
+
+import numpy
+
+from seating import Searcher, AnnealingSearcher, ConstantTemperature, NullLogger, estimate_temperature
+
+
+class SharedArray(object):
+    """
+    A numpy array living in shared memory, inherited by forked workers.
+    """
+
+    def __init__(self, array):
+        self.dtype = array.dtype
+        self.shape = array.shape
+        self.raw = RawArray('c', array.nbytes)
+        self.array()[...] = array
+
+    def array(self):
+        return numpy.frombuffer(self.raw, dtype=self.dtype).reshape(self.shape)
+
+
+class ParallelSearcher(Searcher):
+    """
+    Runs independent chains of another searcher in a pool of processes.
+
+    Every chain starts from the best state found so far, runs sync_interval
+    steps, or what is left of n, and publishes its result to shared memory
+    if it is better. The seating and geometry of the best state are kept in
+    shared buffers, so no state is serialised between processes. n is the
+    number of steps per worker. Only dense States are supported.
+    """
+
+    def __init__(self, searcher, workers=None, sync_interval=1000, logger=None):
+        self.searcher = searcher
+        self.workers = workers if workers else multiprocessing.cpu_count()
+        self.sync_interval = sync_interval
+        self.logger = logger
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.log(msg)
+
+    def search(self, start, n=10000):
+        self.log("Searching with %d workers... " % self.workers)
+        seating = SharedArray(start.seating)
+        geometry = SharedArray(start.geometry)
+        energy = multiprocessing.Value('d', float('inf'), lock=False)
+        lock = multiprocessing.Lock()
+
+        chains = [steps for steps in _rounds(n, self.sync_interval) for _ in range(self.workers)]
+        pool = multiprocessing.Pool(self.workers,
+                                    initializer=_init_worker,
+                                    initargs=(start, self.searcher, seating, geometry, energy, lock))
+        try:
+            for improved, e in pool.imap_unordered(_run_chain, chains):
+                if improved:
+                    self.log("New best state energy: " + str(e))
+        finally:
+            pool.close()
+            pool.join()
+
+        state = start.copy()
+        state.seating = seating.array().copy()
+        state.geometry = geometry.array().copy()
+        self.log("Done")
+        return state, energy.value
+
+
+class ReplicaExchangeSearcher(Searcher):
+    """
+    Parallel tempering: one annealing chain per temperature, each run in the
+    process pool, exchanging states between neighbouring temperatures every
+    exchange_interval steps. n is the number of steps per replica.
+
+    Without explicit temperatures a geometric ladder is used, going from
+    accepting 1% to 50% of the average uphill step from the start state.
+    """
+
+    def __init__(self, stepper, state_evaluator, temperatures=None, replicas=None, workers=None,
+                 exchange_interval=100, logger=None):
+        self.stepper = stepper
+        self.state_evaluator = state_evaluator
+        self.workers = workers if workers else multiprocessing.cpu_count()
+        self.replicas = replicas if replicas else self.workers
+        self.temperatures = temperatures
+        self.exchange_interval = exchange_interval
+        self.logger = logger
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.log(msg)
+
+    def ladder(self, start):
+        low = estimate_temperature(start, self.stepper, self.state_evaluator, acceptance=0.01)
+        high = estimate_temperature(start, self.stepper, self.state_evaluator, acceptance=0.5)
+        if self.replicas == 1:
+            return [low]
+        return [low * (high / low) ** (k / float(self.replicas - 1)) for k in range(self.replicas)]
+
+    def search(self, start, n=10000):
+        temperatures = self.temperatures if self.temperatures else self.ladder(start)
+        self.log("Replica exchange at temperatures %s... " % temperatures)
+
+        # Only seatings are sent to and from the workers, geometry follows
+        e = self.state_evaluator.evaluate(start)
+        replicas = [(start.seating, e)] * len(temperatures)
+        best = start.seating
+        best_e = e
+
+        pool = multiprocessing.Pool(self.workers,
+                                    initializer=_init_replica_worker,
+                                    initargs=(start, self.stepper, self.state_evaluator))
+        try:
+            for r, steps in enumerate(_rounds(n, self.exchange_interval)):
+                tasks = [(seating, temperature, steps) for (seating, _), temperature in zip(replicas, temperatures)]
+                replicas = []
+                for seating, e, best_seating, e_best in pool.map(_run_replica, tasks):
+                    replicas.append((seating, e))
+                    if e_best < best_e:
+                        best = best_seating
+                        best_e = e_best
+                        self.log("New best state energy: " + str(best_e))
+                _exchange(replicas, temperatures, r % 2)
+        finally:
+            pool.close()
+            pool.join()
+
+        state = start.copy()
+        state.seating = best.copy()
+        state.geometry = state.seating.copy().transpose()
+        self.log("Done")
+        return state, best_e
+
+
+def _exchange(replicas, temperatures, offset):
+    """
+    Metropolis exchange of the states of neighbouring temperatures, every
+    other pair starting at offset.
+    """
+    for k in range(offset, len(replicas) - 1, 2):
+        e1, e2 = replicas[k][1], replicas[k + 1][1]
+        x = (1.0 / temperatures[k] - 1.0 / temperatures[k + 1]) * (e1 - e2)
+        if x >= 0 or random.random() < math.exp(x):
+            replicas[k], replicas[k + 1] = replicas[k + 1], replicas[k]
+
+
+_worker = None
+
+
+def _seed():
+    # Forked workers inherit the parent's random state
+    seed = int(os.urandom(4).encode('hex'), 16)
+    numpy.random.seed(seed)
+    random.seed(seed)
+
+
+def _init_worker(template, searcher, seating, geometry, energy, lock):
+    global _worker
+    _seed()
+    _worker = (template, searcher, seating, geometry, energy, lock)
+
+
+def _init_replica_worker(template, stepper, state_evaluator):
+    global _worker
+    _seed()
+    _worker = (template, stepper, state_evaluator)
+
+
+def _run_replica(task):
+    template, stepper, state_evaluator = _worker
+    seating, temperature, n = task
+    state = template.copy()
+    state.seating, state.geometry = seating, seating.copy().transpose()
+
+    searcher = AnnealingSearcher(stepper, state_evaluator, NullLogger(), ConstantTemperature(temperature))
+    state, e, best_state, best_e = searcher.chain(state, n)
+    return state.seating, e, best_state.seating, best_e
+
+
+def _rounds(n, interval):
+    """
+    Steps per round when running n steps, interval steps at a time.
+    """
+    rounds = [interval] * (n // interval)
+    if n % interval or not rounds:
+        rounds.append(n % interval)
+    return rounds
+
+
+def _run_chain(n):
+    template, searcher, seating, geometry, energy, lock = _worker
+    state = template.copy()
+    with lock:
+        state.seating = seating.array().copy()
+        state.geometry = geometry.array().copy()
+
+    state, e = searcher.search(state, n)
+
+    with lock:
+        if e < energy.value:
+            seating.array()[...] = state.seating
+            geometry.array()[...] = state.geometry
+            energy.value = e
+            return True, e
+    return False, e
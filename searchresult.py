@@ -1,19 +1,47 @@
+import math
+import struct
+
 import simplejson
 
+from seating import State
+from wire import encode_state, decode_state
+
+
+def plain(energy):
+    """
+    Energies are often numpy scalars, which simplejson does not accept.
+    """
+    return energy.item() if hasattr(energy, 'item') else energy
+
 
 class SearchResult(object):
 
-    def __init__(self):
-        self.state = None
-        self.energy = None
+    def __init__(self, state=None, energy=None):
+        self.state = state
+        self.energy = energy
 
     def to_json(self):
-        return simplejson.dumps({'state': self.state.to_json, 'energy': self.energy})
+        return simplejson.dumps({'state': self.state.to_json(), 'energy': plain(self.energy)})
 
     @classmethod
     def from_json(cls, json):
         state_as_dict = simplejson.loads(json)
         state = cls()
-        state.state = state_as_dict.get('state')
+        state.state = State.from_json(state_as_dict.get('state'))
         state.energy = state_as_dict.get('energy')
         return state
+
+    def to_bytes(self, registry):
+        """
+        @type registry: wire.StaticRegistry
+        """
+        energy = float('nan') if self.energy is None else self.energy
+        return struct.pack('<d', energy) + encode_state(self.state, registry)
+
+    @classmethod
+    def from_bytes(cls, data, registry):
+        """
+        @type registry: wire.StaticRegistry
+        """
+        energy, = struct.unpack_from('<d', data)
+        return cls(decode_state(data[8:], registry), None if math.isnan(energy) else energy)
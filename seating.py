@@ -1,15 +1,22 @@
 from StringIO import StringIO
-from operator import itemgetter
+from collections import OrderedDict
 import random
-import itertools
+import math
+import threading
+import time
 
 from bunch import Bunch
 import numpy
 import simplejson
 
+from metrics import METRICS
+
 
 class State(Bunch):
 
+    # The seating array and the hash of it, see hash()
+    _zobrist = None
+
     def __init__(self, names=None, group_names=None, group_indexes=None, group_weights=None, seating=None, weights=None, fixed=None, geometry=None):
         super(State, self).__init__()
 
@@ -31,10 +38,12 @@ class State(Bunch):
     def __eq__(self, other):
         if type(other) != State:
             return False
+        if self.seating.shape != other.seating.shape or self.hash() != other.hash():
+            return False
 
         for key in self:
             if isinstance(self[key], (numpy.ndarray, numpy.generic)):
-                if not numpy.array_equal(self[key], self[key]):
+                if not numpy.array_equal(self[key], other[key]):
                     return False
             else:
                 if self[key] != other[key]:
@@ -60,6 +69,36 @@ class State(Bunch):
     def persons(self):
         return self.seating.shape[0]
 
+    def weighted_seating(self):
+        return self.seating * self.weights
+
+    def hash(self):
+        """
+        Zobrist style hash of the seating: the XOR of a pseudo random key for
+        every occupied (person, column). Computed once per seating array and
+        then kept up to date by swap in constant time.
+        """
+        zobrist = self._zobrist
+        if zobrist is None or zobrist[0] is not self.seating:
+            rows, cols = self.seating.nonzero()
+            zobrist = self._zobrist = (self.seating, _zobrist(rows, cols, self.seating.shape[1]))
+        return zobrist[1]
+
+    def _swap_hash(self, p1, c1, p2, c2):
+        """
+        Updates a known hash for p1 at column c1 and p2 at c2 trading places.
+        """
+        zobrist = self._zobrist
+        if zobrist is not None and zobrist[0] is self.seating:
+            keys = _zobrist([p1, p2, p1, p2], [c1, c2, c2, c1], self.seating.shape[1])
+            self._zobrist = (self.seating, zobrist[1] ^ keys)
+
+    def _copy_hash(self, result):
+        zobrist = self._zobrist
+        if zobrist is not None and zobrist[0] is self.seating:
+            result._zobrist = (result.seating, zobrist[1])
+        return result
+
     @staticmethod
     def from_json(json):
         values = simplejson.loads(json)
@@ -85,16 +124,16 @@ class State(Bunch):
         })
 
     def copy(self):
-        return State(names=self.names,
-                     group_names=self.group_names,
-                     group_indexes=self.group_indexes,
-                     group_weights=self.group_weights,
-                     seating=self.seating.copy(),
-                     fixed=self.fixed,
-                     weights=self.weights,
-                     geometry=self.geometry.copy())
-
-    def swap(self, i, j, p1, p2):
+        return self._copy_hash(State(names=self.names,
+                                     group_names=self.group_names,
+                                     group_indexes=self.group_indexes,
+                                     group_weights=self.group_weights,
+                                     seating=self.seating.copy(),
+                                     fixed=self.fixed,
+                                     weights=self.weights,
+                                     geometry=self.geometry.copy()))
+
+    def can_swap(self, i, j, p1, p2):
         p1_seating = self.seating[p1, i:j]
         p2_seating = self.seating[p2, i:j]
 
@@ -110,74 +149,112 @@ class State(Bunch):
         p2_locked = numpy.any(p2_seating * self.fixed[p2, i:j])
         if p2_locked:
             return False
-        self.seating[p1, i:j], self.seating[p2, i:j] = p2_seating.copy(), p1_seating.copy()
-        self.geometry[i:j, p1], self.geometry[i:j, p2] = self.geometry[i:j, p2].copy(), self.geometry[i:j, p1].copy()
+        return True
+
+    def swap(self, i, j, p1, p2, check=True):
+        """
+        Swaps the tables of p1 and p2 in the meal i:j if both attend it and
+        neither is fixed. Moves sampled from a MoveIndex need no check.
+        """
+        if check and not self.can_swap(i, j, p1, p2):
+            return False
+        _exchange(self, i, j, p1, p2)
         return True
 
     def shuffle(self):
-        for i, j in self.group_indexes:
-            if i + 1 == j:
-                continue
-            for p1 in range(self.persons):
-                p2 = numpy.random.choice(self.persons)
-                if self.swap(i, j, p1, p2):
-                    self.seating = self.seating.copy()
-                    self.geometry = self.geometry.copy()
+        """
+        Seats the persons that can be moved in each meal at a random
+        permutation of their tables, which keeps table sizes and fixed seats.
+        """
+        for i, j, persons in MoveIndex(self).choices:
+            tables = i + numpy.argmax(self.seating[persons, i:j], axis=1)
+            shuffled = numpy.random.permutation(tables)
+            self.seating[persons, tables] = 0
+            self.seating[persons, shuffled] = 1
+            self.geometry[tables, persons] = 0
+            self.geometry[shuffled, persons] = 1
+        self._zobrist = None
+
+    def seat_greedily(self):
+        """
+        Seats the persons that can be moved in each meal at the tables chosen
+        by greedy_tables, which keeps table sizes and fixed seats.
+        """
+        for i, j, persons, seated in greedy_tables(self):
+            tables = i + numpy.argmax(self.seating[persons, i:j], axis=1)
+            self.seating[persons, tables] = 0
+            self.seating[persons, seated] = 1
+            self.geometry[tables, persons] = 0
+            self.geometry[seated, persons] = 1
+        self._zobrist = None
+
+
+def _splitmix64(x):
+    z = x + numpy.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return z ^ (z >> numpy.uint64(31))
+
+
+def _zobrist(rows, cols, columns):
+    """
+    XOR of the keys of the cells (rows[k], cols[k]) in a matrix with columns
+    columns, each key being splitmix64 of the cell's flat index.
+    """
+    cells = numpy.asarray(rows, dtype=numpy.uint64) * numpy.uint64(columns) + numpy.asarray(cols, dtype=numpy.uint64)
+    if not len(cells):
+        return 0
+    return int(numpy.bitwise_xor.reduce(_splitmix64(cells)))
 
 
 def closeness(state):
-    result = numpy.dot(state.seating, state.geometry)
-    numpy.fill_diagonal(result, 0)
+    result = state.seating.dot(state.geometry)
+    _clear_diagonal(result)
     return result
 
 
+def _clear_diagonal(n):
+    """
+    Zeroes the diagonal of a dense or scipy.sparse matrix without changing
+    the sparsity structure.
+    """
+    diagonal = numpy.nonzero(n.diagonal())[0]
+    n[diagonal, diagonal] = 0
+    if hasattr(n, 'eliminate_zeros'):
+        n.eliminate_zeros()
+
+
+def _dot(a, b):
+    """
+    a.dot(b) for dense or scipy.sparse matrices, with dense integer products
+    done in floating point where numpy uses BLAS, which is exact for
+    seating counts and many times faster.
+    """
+    if hasattr(a, 'tocsr') or hasattr(b, 'tocsr') or a.dtype.kind == 'f':
+        return a.dot(b)
+    dtype = numpy.result_type(a, b)
+    return a.astype(float).dot(b.astype(float)).astype(dtype)
+
+
+def _values(n):
+    """
+    The (stored) values of a dense or scipy.sparse closeness matrix.
+    """
+    return n.tocsr().data if hasattr(n, 'tocsr') else n
+
+
 def energy_sum(state):
-    n = closeness(state)
+    n = _values(closeness(state))
     return sum(n[n > 1])
 
 
 def energy_sum_of_square(state):
-    n = closeness(state)
+    n = _values(closeness(state))
     return sum(n[n > 1] ** 2)
 
 
 def fast_search(initial_state, score=energy_sum_of_square, n=1000):
-
-    choices = []
-    for i, j in initial_state.group_indexes:
-        if i + 1 < j:
-            persons = numpy.where(initial_state.seating[:, i:j].any(axis=1))[0]
-            fixed_persons = numpy.where(initial_state.fixed[:, i:j].any(axis=1))[0]
-            persons = [person for person in persons if person not in fixed_persons]
-            choices.append((i, j, persons))
-
-    def _swap(state, i, j, p1, p2):
-        state.seating[p1, i:j], state.seating[p2, i:j] = state.seating[p2, i:j].copy(), state.seating[p1, i:j].copy()
-        state.geometry[i:j, p1], state.geometry[i:j, p2] = state.geometry[i:j, p2].copy(), state.geometry[i:j, p1].copy()
-
-    steps = 5
-
-    choice_iterator = itertools.cycle(choices)
-
-    state = initial_state
-    e = score(state)
-    for _ in range(n):
-        i, j, persons = next(choice_iterator)
-        random.shuffle(persons)
-        pivot = min(steps, len(persons) / 2)
-        a, b, = persons[:pivot], persons[pivot:]
-        swaps = [(p1, random.choice(b)) for p1 in a]
-        for p1, p2 in swaps:
-            _swap(state, i, j, p1, p2)
-        new_e = score(state)
-        if new_e >= e:
-            swaps.reverse()
-            for p1, p2 in swaps:
-                _swap(state, i, j, p1, p2)
-        else:
-            print e
-            e = new_e
-
+    state, _ = FastSearcher(score).search(initial_state, n)
     return state
 
 
@@ -214,45 +291,210 @@ def start_seating(persons=150, meals=5, groups=10, positions=15):
                  geometry=geometry)
 
 
+class MoveIndex(object):
+    """
+    The persons that can be swapped in each meal, those attending it and not
+    fixed there, as (i, j, persons) for the meals with at least two of them.
+    Swaps keep attendance and fixed seats, so an index stays valid for every
+    state reached by swaps from the one it was built from.
+    """
+
+    def __init__(self, state):
+        self.fixed = state.fixed
+        self.choices = []
+        for i, j in state.group_indexes:
+            if i + 1 == j:
+                continue
+            seating = state.seating[:, i:j]
+            fixed = state.fixed[:, i:j]
+            if hasattr(seating, 'multiply'):
+                attending = numpy.asarray(seating.sum(axis=1)).ravel() > 0
+                locked = numpy.asarray(seating.multiply(fixed).sum(axis=1)).ravel() > 0
+            else:
+                seated = seating != 0
+                attending = seated.any(axis=1)
+                locked = (seated & fixed).any(axis=1)
+            persons = numpy.flatnonzero(attending & ~locked)
+            if len(persons) >= 2:
+                self.choices.append((i, j, persons))
+
+    @staticmethod
+    def of(state, index=None):
+        """
+        index if it was built for a state with the same fixed seats, else a
+        new index for state.
+        """
+        if index is not None and index.fixed is state.fixed:
+            return index
+        return MoveIndex(state)
+
+    def sample(self):
+        """
+        A random legal move (i, j, p1, p2) of two different persons.
+        """
+        if not self.choices:
+            raise Exception("No meal has two persons that can be swapped")
+        i, j, persons = self.choices[random.randrange(len(self.choices))]
+        p1, p2 = numpy.random.choice(persons, 2, replace=False)
+        return i, j, p1, p2
+
+
+def greedy_tables(state):
+    """
+    New tables for the persons that can be moved in each meal, as
+    (i, j, persons, tables). Meals are seated in order and tables one at a
+    time, each free seat going to the person that adds the least to
+    energy_sum given the groups, the meals seated before and the persons
+    already at the table. Ties go to a random person.
+    """
+    rows, cols = state.seating.nonzero()
+    rows, cols = numpy.asarray(rows), numpy.asarray(cols)
+    columns = state.seating.shape[1]
+    column_weights = numpy.array([weight for (i, j), weight in zip(state.group_indexes, state.group_weights)
+                                  for _ in range(i, j)])
+
+    by_column = numpy.argsort(cols, kind='mergesort')
+    bounds = numpy.searchsorted(cols[by_column], numpy.arange(columns + 1))
+    members = [rows[by_column[bounds[c]:bounds[c + 1]]] for c in range(columns)]
+    person_columns = [[] for _ in range(state.persons)]
+    for p, c in zip(rows, cols):
+        person_columns[p].append(c)
+
+    # Columns whose seating is final, the groups to begin with
+    known = numpy.zeros(columns, dtype=bool)
+    for i, j in state.group_indexes:
+        known[i:j] = i + 1 == j
+
+    def added(p, weight):
+        n = numpy.zeros(state.persons)
+        for c in person_columns[p]:
+            if known[c]:
+                n[members[c]] += column_weights[c]
+        return numpy.where(n + weight > 1, n + weight, 0) - numpy.where(n > 1, n, 0)
+
+    choices = dict((i, persons) for i, j, persons in MoveIndex(state).choices)
+    result = []
+    for i, j in state.group_indexes:
+        if i not in choices:
+            known[i:j] = True
+            continue
+        persons = choices[i]
+        movable = numpy.zeros(state.persons, dtype=bool)
+        movable[persons] = True
+        weight = column_weights[i]
+
+        old = numpy.array([next(c for c in person_columns[p] if i <= c < j) for p in persons])
+        sizes = numpy.bincount(old - i, minlength=j - i)
+        order = numpy.random.permutation(persons)
+        unseated = movable.copy()
+        tables = numpy.empty(state.persons, dtype=int)
+        seated = [[p for p in members[t] if not movable[p]] for t in range(i, j)]
+        cost = numpy.zeros((j - i, state.persons))
+        for t, staying in enumerate(seated):
+            for p in staying:
+                cost[t] += added(p, weight)
+        # Seat by seat round the tables, so that no table is left with the
+        # persons nobody else wanted
+        free = sizes.copy()
+        while free.any():
+            for t in numpy.flatnonzero(free):
+                candidates = order[unseated[order]]
+                q = candidates[numpy.argmin(cost[t, candidates])]
+                unseated[q] = False
+                tables[q] = i + t
+                seated[t].append(q)
+                free[t] -= 1
+                cost[t] += added(q, weight)
+        for t in range(i, j):
+            members[t] = numpy.array(sorted(seated[t - i]), dtype=int)
+
+        for p, c in zip(persons, old):
+            person_columns[p].remove(c)
+            person_columns[p].append(tables[p])
+        known[i:j] = True
+        result.append((i, j, persons, tables[persons]))
+    return result
+
+
 class Stepper(object):
+    _index = None
+    _rejected = 0
+
     def step(self, state):
+        result = state.copy()
+        result.swap(*self.propose(state), check=False)
+        return result
+
+    def flush_metrics(self):
+        """
+        Adds what was counted since the last flush to METRICS.
+        """
+        if self._rejected:
+            METRICS.count('stepper.rejected', self._rejected)
+            self._rejected = 0
+
+    def propose(self, state):
+        """
+        A move (i, j, p1, p2) that state.swap accepts, without making it.
+        """
         raise NotImplementedError
 
 
 class BlindStepper(Stepper):
-    def step(self, state):
-        result = state.copy()
-        while True:
-            i, j = random.choice(state.group_indexes)
-            if i + 1 == j:
-                continue
-            if result.swap(i, j,
-                           numpy.random.choice(state.persons),
-                           numpy.random.choice(state.persons)):
-                return result
+    def propose(self, state):
+        self._index = MoveIndex.of(state, self._index)
+        return self._index.sample()
 
 
 class ClosenessStepper(Stepper):
     def __init__(self, closeness_evaluator):
         self.closeness_evaluator = closeness_evaluator
 
-    def step(self, state):
-        result = state.copy()
+    def propose(self, state):
+        self._index = MoveIndex.of(state, self._index)
         c = self._candidates(state)
-        while True:
-            i, j = random.choice(state.group_indexes)
-            if i + 1 == j:
-                continue
-            if result.swap(i, j,
-                           numpy.random.choice(c),
-                           numpy.random.choice(state.persons)):
-                return result
+        # Meals where some of the closest persons can be moved
+        choices = [(i, j, numpy.intersect1d(c, persons, assume_unique=True), persons)
+                   for i, j, persons in self._index.choices]
+        choices = [choice for choice in choices if len(choice[2])]
+        if not choices:
+            self._rejected += 1
+            return self._index.sample()
+        i, j, candidates, persons = choices[random.randrange(len(choices))]
+        return i, j, numpy.random.choice(candidates), numpy.random.choice(persons)
 
     def _candidates(self, state):
         n = self.closeness_evaluator.closeness(state)
         return numpy.where(n == n.max())[0]
 
 
+class BestOfKStepper(Stepper):
+    """
+    Scores k random swaps within one meal at once with the deltas of an
+    incremental closeness evaluator and makes the one that lowers the energy
+    sum the most.
+    """
+
+    def __init__(self, closeness_evaluator=None, k=32):
+        """
+        @type closeness_evaluator: IncrementalClosenessEvaluator
+        """
+        self.closeness_evaluator = closeness_evaluator if closeness_evaluator is not None \
+            else IncrementalClosenessEvaluator()
+        self.k = k
+
+    def propose(self, state):
+        self._index = MoveIndex.of(state, self._index)
+        if not self._index.choices:
+            return self._index.sample()
+        i, j, movable = random.choice(self._index.choices)
+        p1s = numpy.random.choice(movable, self.k)
+        p2s = numpy.random.choice(movable, self.k)
+        deltas, _ = self.closeness_evaluator.deltas(state, i, j, p1s, p2s)
+        best = numpy.argmin(deltas)
+        return i, j, p1s[best], p2s[best]
+
+
 class ClosenessEvaluator(object):
     def closeness(self, state):
         raise NotImplementedError
@@ -260,9 +502,8 @@ class ClosenessEvaluator(object):
 
 class TablePositionAgnosticClosnessEvaluator(ClosenessEvaluator):
     def closeness(self, state):
-        result = numpy.dot(state.seating * state.weights, state.geometry)
-        size = result.shape[0]
-        result[numpy.arange(size), numpy.arange(size)] = 0
+        result = state.weighted_seating().dot(state.geometry)
+        _clear_diagonal(result)
         return result
 
 
@@ -270,18 +511,276 @@ class StateEvaluator(object):
     def evaluate(self, state):
         pass
 
+    def flush_metrics(self):
+        pass
+
+
+class EnergyCache(object):
+    """
+    Energies of recently evaluated states by State.hash(), dropping the least
+    recently used beyond size. Shared between threads. Hits and misses are
+    added to METRICS by flush_metrics.
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self._energies = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = self._misses = 0
+
+    def get(self, state):
+        key = state.hash()
+        with self._lock:
+            energy = self._energies.pop(key, None)
+            if energy is not None:
+                self._energies[key] = energy
+                self._hits += 1
+            else:
+                self._misses += 1
+        return energy
+
+    def flush_metrics(self):
+        with self._lock:
+            hits, misses = self._hits, self._misses
+            self._hits = self._misses = 0
+        METRICS.count('cache.hits', hits)
+        METRICS.count('cache.misses', misses)
+
+    def put(self, state, energy):
+        key = state.hash()
+        with self._lock:
+            self._energies.pop(key, None)
+            self._energies[key] = energy
+            if len(self._energies) > self.size:
+                self._energies.popitem(last=False)
+
 
 class SquareStateEvaluator(StateEvaluator):
-    def __init__(self, closeness_evaluator):
+    def __init__(self, closeness_evaluator, cache=None):
+        """
+        @type cache: EnergyCache
+        """
         self.closeness_evaluator = closeness_evaluator
+        self.cache = cache
 
     def evaluate(self, state):
-        return self._energy_sum(state) ** 2
+        if self.cache is None:
+            return self._energy_sum(state) ** 2
+        energy = self.cache.get(state)
+        if energy is None:
+            energy = self._energy_sum(state) ** 2
+            self.cache.put(state, energy)
+        return energy
 
     def _energy_sum(self, state):
-        n = self.closeness_evaluator.closeness(state)
+        n = _values(self.closeness_evaluator.closeness(state))
         return sum(n[n > 1])
 
+    def flush_metrics(self):
+        if self.cache is not None:
+            self.cache.flush_metrics()
+
+
+class IncrementalClosenessEvaluator(TablePositionAgnosticClosnessEvaluator):
+    """
+    Keeps the closeness matrix and energies of the last seen state up to date
+    across swaps, so that a swap costs O(persons) instead of a full product.
+
+    Swaps of the tracked state must go through swap()/undo(), and the returned
+    closeness matrix must not be modified by the caller.
+    """
+
+    def __init__(self, weighted=True):
+        self.weighted = weighted
+        self._state = None
+        self._closeness = None
+        self._energy_sum = 0
+        self._energy_sum_of_square = 0
+        self._undo = []
+
+    def track(self, state):
+        if state is self._state:
+            return
+        if self.weighted:
+            n = super(IncrementalClosenessEvaluator, self).closeness(state)
+        else:
+            n = closeness(state)
+        self._state = state
+        self._closeness = n
+        self._energy_sum = n[n > 1].sum()
+        self._energy_sum_of_square = (n[n > 1] ** 2).sum()
+        self._undo = []
+
+    def closeness(self, state):
+        self.track(state)
+        return self._closeness
+
+    def energy_sum(self, state):
+        self.track(state)
+        return self._energy_sum
+
+    def energy_sum_of_square(self, state):
+        self.track(state)
+        return self._energy_sum_of_square
+
+    def delta(self, state, i, j, p1, p2):
+        """
+        Change of (energy_sum, energy_sum_of_square) if p1 and p2 were swapped
+        in the meal i:j, or None if the swap is not allowed.
+        """
+        self.track(state)
+        if not state.can_swap(i, j, p1, p2):
+            return None
+        delta_sum, delta_sum_of_square = self.deltas(state, i, j, [p1], [p2])
+        return delta_sum[0], delta_sum_of_square[0]
+
+    def deltas(self, state, i, j, p1s, p2s):
+        """
+        Changes of (energy_sum, energy_sum_of_square) for each of the swaps of
+        p1s[k] and p2s[k] in the meal i:j, scored together. All swaps must be
+        allowed.
+        """
+        self.track(state)
+        old, new, others = self._swapped(state, i, j, numpy.asarray(p1s), numpy.asarray(p2s))
+        old = old * (old > 1) * others
+        new = new * (new > 1) * others
+        return (new - old).sum(axis=(0, 2)), (new ** 2 - old ** 2).sum(axis=(0, 2))
+
+    def swap(self, state, i, j, p1, p2):
+        changes = self._changes(state, i, j, p1, p2)
+        if changes is None:
+            return False
+        rows, cols, new = changes
+        old = self._closeness[rows, cols]
+        delta_sum, delta_sum_of_square = _energy_delta(old, new)
+        state.swap(i, j, p1, p2)
+        self._closeness[rows, cols] = new
+        self._undo.append((i, j, p1, p2, rows, cols, old, self._energy_sum, self._energy_sum_of_square))
+        self._energy_sum += delta_sum
+        self._energy_sum_of_square += delta_sum_of_square
+        return True
+
+    def undo(self, state):
+        """
+        Reverts the most recent swap that has not been committed.
+        """
+        self.track(state)
+        i, j, p1, p2, rows, cols, old, self._energy_sum, self._energy_sum_of_square = self._undo.pop()
+        state.swap(i, j, p1, p2)
+        self._closeness[rows, cols] = old
+
+    def commit(self, state):
+        """
+        Forgets the undo history of the tracked state.
+        """
+        self.track(state)
+        self._undo = []
+
+    def _changes(self, state, i, j, p1, p2):
+        self.track(state)
+        if not state.can_swap(i, j, p1, p2):
+            return None
+
+        seating = state.seating
+        if numpy.argmax(seating[p1, i:j]) == numpy.argmax(seating[p2, i:j]):
+            empty = numpy.array([], dtype=int)
+            return empty, empty, empty
+
+        _, new, others = self._swapped(state, i, j, numpy.array([p1]), numpy.array([p2]))
+        others = numpy.flatnonzero(others[0])
+        p1s = numpy.repeat(p1, len(others))
+        p2s = numpy.repeat(p2, len(others))
+        rows = numpy.concatenate([p1s, p2s, others, others])
+        cols = numpy.concatenate([others, others, p1s, p2s])
+        return rows, cols, new[:, 0, others].ravel()
+
+    def _swapped(self, state, i, j, p1s, p2s):
+        """
+        The rows of p1s[k] and p2s[k] and the columns of them in the
+        closeness, as they are and after the k:th swap, stacked as (old, new)
+        of shape (4, k, persons). others masks out the entries between p1s[k]
+        and p2s[k] and on the diagonal, which do not change.
+        """
+        seating = state.seating
+        t1 = i + numpy.argmax(seating[p1s, i:j], axis=1)
+        t2 = i + numpy.argmax(seating[p2s, i:j], axis=1)
+
+        at_t1 = seating[:, t1].T
+        at_t2 = seating[:, t2].T
+        if self.weighted:
+            weights = state.weights
+            a = at_t1 * weights[:, t1].T
+            b = at_t2 * weights[:, t2].T
+            p1_rows = weights[p1s, t2][:, None] * at_t2 - weights[p1s, t1][:, None] * at_t1
+            p2_rows = weights[p2s, t1][:, None] * at_t1 - weights[p2s, t2][:, None] * at_t2
+        else:
+            a, b = at_t1, at_t2
+            p1_rows = at_t2 - at_t1
+            p2_rows = at_t1 - at_t2
+
+        n = self._closeness
+        old = numpy.stack([n[p1s], n[p2s], n[:, p1s].T, n[:, p2s].T])
+        new = old + numpy.stack([p1_rows, p2_rows, b - a, a - b])
+
+        others = numpy.ones(old.shape[1:], dtype=bool)
+        others[numpy.arange(len(p1s)), p1s] = False
+        others[numpy.arange(len(p2s)), p2s] = False
+        return old, new, others
+
+
+def _energy_delta(old, new):
+    old = old[old > 1]
+    new = new[new > 1]
+    return new.sum() - old.sum(), (new ** 2).sum() - (old ** 2).sum()
+
+
+class IncrementalSquareStateEvaluator(SquareStateEvaluator):
+    """
+    SquareStateEvaluator that can score and apply single swaps incrementally.
+    """
+
+    def __init__(self, closeness_evaluator=None):
+        super(IncrementalSquareStateEvaluator, self).__init__(
+            closeness_evaluator if closeness_evaluator is not None else IncrementalClosenessEvaluator())
+
+    def _energy_sum(self, state):
+        return self.closeness_evaluator.energy_sum(state)
+
+    def delta(self, state, i, j, p1, p2):
+        delta = self.closeness_evaluator.delta(state, i, j, p1, p2)
+        if delta is None:
+            return None
+        e = self._energy_sum(state)
+        return (e + delta[0]) ** 2 - e ** 2
+
+    def swap(self, state, i, j, p1, p2):
+        return self.closeness_evaluator.swap(state, i, j, p1, p2)
+
+    def undo(self, state):
+        self.closeness_evaluator.undo(state)
+
+    def commit(self, state):
+        self.closeness_evaluator.commit(state)
+
+
+class IncrementalSumOfSquareStateEvaluator(IncrementalSquareStateEvaluator):
+    """
+    Incremental counterpart of energy_sum_of_square.
+    """
+
+    def __init__(self, closeness_evaluator=None):
+        super(IncrementalSumOfSquareStateEvaluator, self).__init__(
+            closeness_evaluator if closeness_evaluator is not None else IncrementalClosenessEvaluator(weighted=False))
+
+    def evaluate(self, state):
+        return self.closeness_evaluator.energy_sum_of_square(state)
+
+    def delta(self, state, i, j, p1, p2):
+        delta = self.closeness_evaluator.delta(state, i, j, p1, p2)
+        if delta is None:
+            return None
+        return delta[1]
+
 
 def persons_at_each_table(state):
     return state.seating.sum(axis=0)
@@ -292,6 +791,10 @@ class Searcher(object):
         pass
 
 
+# One in this many steps is timed into search.stepper and search.evaluator
+TIMING_INTERVAL = 16
+
+
 class SingleThreadedSearcher(Searcher):
 
     def __init__(self, stepper, state_evaluator, logger):
@@ -306,13 +809,446 @@ class SingleThreadedSearcher(Searcher):
         self.log("Searching... ")
         state = start
 
+        started = time.time()
+        stepping = evaluating = 0.0
+        accepted = timed = 0
+        e = self.state_evaluator.evaluate(state)
+        for t in range(n):
+            # Timing every step costs more than the split is worth
+            if t % TIMING_INTERVAL:
+                new_state = self.stepper.step(state)
+                new_e = self.state_evaluator.evaluate(new_state)
+            else:
+                t0 = time.time()
+                new_state = self.stepper.step(state)
+                t1 = time.time()
+                new_e = self.state_evaluator.evaluate(new_state)
+                evaluating += time.time() - t1
+                stepping += t1 - t0
+                timed += 1
+            if new_e < e:
+                state = new_state
+                e = new_e
+                accepted += 1
+                self.log("New best state energy: " + str(e))
+        METRICS.count('search.steps', n)
+        METRICS.count('search.accepted', accepted)
+        METRICS.add_time('search.stepper', stepping, timed)
+        METRICS.add_time('search.evaluator', evaluating, timed)
+        METRICS.add_time('search', time.time() - started)
+        self.stepper.flush_metrics()
+        self.state_evaluator.flush_metrics()
+        self.log("Done")
+        return state, e
+
+
+class FastSearcher(Searcher):
+    """
+    Greedy search with compound moves of several swaps within one meal,
+    each move scored with one call to score.
+
+    The number of swaps per move shrinks when few moves are accepted and
+    grows back when many are, and meals are picked in proportion to their
+    recent acceptance rate. Improvements are passed to callback(t, e) and
+    logged at most every log_interval seconds. The search stops after n
+    moves or seconds of wall-clock time, whichever comes first.
+    """
+
+    def __init__(self, score=energy_sum_of_square, logger=None, callback=None, log_interval=1.0,
+                 max_steps=5, window=100, low_acceptance=0.05, high_acceptance=0.2, seconds=None):
+        self.score = score
+        self.logger = logger
+        self.callback = callback
+        self.log_interval = log_interval
+        self.max_steps = max_steps
+        self.window = window
+        self.low_acceptance = low_acceptance
+        self.high_acceptance = high_acceptance
+        self.seconds = seconds
+        self._index = None
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.log(msg)
+
+    def search(self, start, n=1000):
+        state = start.copy()
+        self._index = MoveIndex.of(state, self._index)
+        choices = [(i, j, list(persons)) for i, j, persons in self._index.choices]
+        if not choices:
+            return state, self.score(state)
+
+        # Smoothed acceptance rate per meal, starting optimistic
+        meal_rates = numpy.ones(len(choices))
+        steps = self.max_steps
+        accepted = 0
+
+        started = last_log = time.time()
+        e = self.score(state)
+        for t in xrange(n):
+            m = numpy.random.choice(len(choices), p=(meal_rates + 0.05) / (meal_rates + 0.05).sum())
+            i, j, persons = choices[m]
+            random.shuffle(persons)
+            pivot = min(steps, len(persons) / 2)
+            a, b, = persons[:pivot], persons[pivot:]
+            swaps = [(p1, random.choice(b)) for p1 in a]
+            for p1, p2 in swaps:
+                _exchange(state, i, j, p1, p2)
+            new_e = self.score(state)
+            improved = new_e < e
+            if not improved:
+                swaps.reverse()
+                for p1, p2 in swaps:
+                    _exchange(state, i, j, p1, p2)
+            else:
+                e = new_e
+                accepted += 1
+                if self.callback is not None:
+                    self.callback(t, e)
+            meal_rates[m] = 0.9 * meal_rates[m] + 0.1 * improved
+
+            if (t + 1) % self.window == 0:
+                rate = accepted / float(self.window)
+                if rate < self.low_acceptance:
+                    steps = max(1, steps - 1)
+                elif rate > self.high_acceptance:
+                    steps = min(self.max_steps, steps + 1)
+                accepted = 0
+
+                now = time.time()
+                if now - last_log >= self.log_interval:
+                    self.log("Energy after %d moves: %s (%d swaps per move)" % (t + 1, e, steps))
+                    last_log = now
+                if self.seconds is not None and now - started >= self.seconds:
+                    break
+
+        return state, e
+
+
+class TabuSearcher(Searcher):
+    """
+    Moves to the best of candidates moves proposed by the stepper at every
+    step, even when it is worse, while swapping back the same pair in the
+    same meal is forbidden for tenure steps unless it beats the best energy
+    found. Moves are scored with the delta() of incremental evaluators.
+    """
+
+    def __init__(self, stepper, state_evaluator, logger, tenure=50, candidates=20):
+        self.stepper = stepper
+        self.state_evaluator = state_evaluator
+        self.logger = logger
+        self.tenure = tenure
+        self.candidates = candidates
+
+    def log(self, msg):
+        self.logger.log(msg)
+
+    def search(self, start, n=10000):
+        self.log("Searching... ")
+        state = start.copy()
+        incremental = hasattr(self.state_evaluator, 'delta')
+
+        started = time.time()
+        accepted = 0
         e = self.state_evaluator.evaluate(state)
+        best_state, best_e = state.copy(), e
+        tabu = {}
+        for t in range(n):
+            chosen = None
+            for _ in range(self.candidates):
+                i, j, p1, p2 = self.stepper.propose(state)
+                if numpy.argmax(state.seating[p1, i:j]) == numpy.argmax(state.seating[p2, i:j]):
+                    # Swapping table mates changes nothing
+                    continue
+                if incremental:
+                    candidate = None
+                    new_e = e + self.state_evaluator.delta(state, i, j, p1, p2)
+                else:
+                    candidate = state.copy()
+                    candidate.swap(i, j, p1, p2)
+                    new_e = self.state_evaluator.evaluate(candidate)
+                move = (i, min(p1, p2), max(p1, p2))
+                if tabu.get(move, -1) >= t and not new_e < best_e:
+                    continue
+                if chosen is None or new_e < chosen[0]:
+                    chosen = (new_e, move, (i, j, p1, p2), candidate)
+            if chosen is None:
+                continue
+
+            e, move, (i, j, p1, p2), candidate = chosen
+            if incremental:
+                self.state_evaluator.swap(state, i, j, p1, p2)
+                self.state_evaluator.commit(state)
+            else:
+                state = candidate
+            tabu[move] = t + self.tenure
+            if e < best_e:
+                accepted += 1
+                best_state, best_e = state.copy(), e
+                self.log("New best state energy: " + str(e))
+            if t % self.tenure == 0:
+                tabu = dict((move, until) for move, until in tabu.items() if until >= t)
+        METRICS.count('search.steps', n)
+        METRICS.count('search.accepted', accepted)
+        METRICS.add_time('search', time.time() - started)
+        self.stepper.flush_metrics()
+        self.state_evaluator.flush_metrics()
+        self.log("Done")
+        return best_state, best_e
+
+
+def _exchange(state, i, j, p1, p2):
+    """
+    Swaps p1 and p2 in the meal i:j without checking that it is allowed.
+    """
+    state._swap_hash(p1, i + numpy.argmax(state.seating[p1, i:j]), p2, i + numpy.argmax(state.seating[p2, i:j]))
+    state.seating[p1, i:j], state.seating[p2, i:j] = state.seating[p2, i:j].copy(), state.seating[p1, i:j].copy()
+    state.geometry[i:j, p1], state.geometry[i:j, p2] = state.geometry[i:j, p2].copy(), state.geometry[i:j, p1].copy()
+
+
+class CoolingSchedule(object):
+    """
+    Temperature of an AnnealingSearcher as a function of the step number.
+    """
+
+    def start(self, n):
+        pass
+
+    def temperature(self, t):
+        raise NotImplementedError
+
+    def update(self, t, delta, accepted, improved):
+        pass
+
+
+class ConstantTemperature(CoolingSchedule):
+    def __init__(self, temperature):
+        self._temperature = temperature
+
+    def temperature(self, t):
+        return self._temperature
+
+
+class GeometricCooling(CoolingSchedule):
+    def __init__(self, start, end):
+        self.start_temperature = float(start)
+        self.end_temperature = float(end)
+        self.n = 1
+
+    def start(self, n):
+        self.n = max(n, 1)
+
+    def temperature(self, t):
+        return self.start_temperature * (self.end_temperature / self.start_temperature) ** (t / float(self.n))
+
+
+class AdaptiveCooling(CoolingSchedule):
+    """
+    Adjusts the temperature so that the share of accepted uphill moves
+    follows a target going from initial_acceptance to final_acceptance.
+    The first temperature is derived from the first uphill move seen.
+    """
+
+    def __init__(self, initial_acceptance=0.5, final_acceptance=0.01, window=100, factor=1.2):
+        self.initial_acceptance = initial_acceptance
+        self.final_acceptance = final_acceptance
+        self.window = window
+        self.factor = factor
+        self.n = 1
+        self._temperature = None
+        self._uphill = 0
+        self._accepted = 0
+
+    def start(self, n):
+        self.n = max(n, 1)
+        self._temperature = None
+        self._uphill = 0
+        self._accepted = 0
+
+    def target(self, t):
+        return self.initial_acceptance * (self.final_acceptance / self.initial_acceptance) ** (t / float(self.n))
+
+    def temperature(self, t):
+        return self._temperature
+
+    def update(self, t, delta, accepted, improved):
+        if delta <= 0:
+            return
+        if self._temperature is None:
+            self._temperature = delta / math.log(1 / self.initial_acceptance)
+            return
+        self._uphill += 1
+        self._accepted += accepted
+        if self._uphill >= self.window:
+            if self._accepted < self.target(t) * self._uphill:
+                self._temperature *= self.factor
+            else:
+                self._temperature /= self.factor
+            self._uphill = 0
+            self._accepted = 0
+
+
+class ReheatingCooling(CoolingSchedule):
+    """
+    Restarts another schedule when the best energy has not improved for
+    patience steps.
+    """
+
+    def __init__(self, schedule, patience=1000):
+        self.schedule = schedule
+        self.patience = patience
+        self._restarted = 0
+        self._improved = 0
+
+    def start(self, n):
+        self.schedule.start(n)
+        self._restarted = 0
+        self._improved = 0
+
+    def temperature(self, t):
+        return self.schedule.temperature(t - self._restarted)
+
+    def update(self, t, delta, accepted, improved):
+        self.schedule.update(t - self._restarted, delta, accepted, improved)
+        if improved:
+            self._improved = t
+        elif t - max(self._improved, self._restarted) >= self.patience:
+            self._restarted = t
+
+
+class AnnealingSearcher(Searcher):
+    """
+    Like SingleThreadedSearcher, but also accepts worse states with
+    probability exp(-delta / temperature). Returns the best state seen.
+    """
+
+    def __init__(self, stepper, state_evaluator, logger, schedule=None):
+        self.stepper = stepper
+        self.state_evaluator = state_evaluator
+        self.logger = logger
+        self.schedule = schedule if schedule is not None else AdaptiveCooling()
+
+    def log(self, msg):
+        self.logger.log(msg)
+
+    def search(self, start, n=10000):
+        self.log("Annealing... ")
+        _, _, best_state, best_e = self.chain(start, n)
+        self.stepper.flush_metrics()
+        self.state_evaluator.flush_metrics()
+        self.log("Done")
+        return best_state, best_e
+
+    def chain(self, start, n):
+        """
+        Runs n steps from start and returns the state and energy the chain
+        ended in, followed by the best state and energy seen.
+        """
+        self.schedule.start(n)
+        state = best_state = start
+
+        e = best_e = self.state_evaluator.evaluate(state)
         for t in range(n):
             new_state = self.stepper.step(state)
             new_e = self.state_evaluator.evaluate(new_state)
-            if new_e < e:
+            delta = new_e - e
+            accepted = delta < 0 or _metropolis(delta, self.schedule.temperature(t))
+            if accepted:
                 state = new_state
                 e = new_e
+            improved = e < best_e
+            if improved:
+                best_state = state
+                best_e = e
+                self.log("New best state energy: " + str(best_e))
+            self.schedule.update(t, delta, accepted, improved)
+        return state, e, best_state, best_e
+
+
+def estimate_temperature(start, stepper, state_evaluator, acceptance=0.5, samples=20):
+    """
+    Temperature at which an average uphill step from start is accepted with
+    the given probability.
+    """
+    e = state_evaluator.evaluate(start)
+    deltas = [state_evaluator.evaluate(stepper.step(start)) - e for _ in range(samples)]
+    uphill = [delta for delta in deltas if delta > 0]
+    if not uphill:
+        return 1.0
+    return (sum(uphill) / float(len(uphill))) / math.log(1 / acceptance)
+
+
+def _metropolis(delta, temperature):
+    if not temperature:
+        return False
+    return random.random() < math.exp(-delta / float(temperature))
+
+
+INITIALIZERS = ['shuffle', 'greedy']
+
+
+def initialize(state, name='shuffle'):
+    """
+    Shuffles state, or seats it greedily, before a search.
+
+    @type state: State
+    """
+    if name == 'shuffle':
+        state.shuffle()
+    elif name == 'greedy':
+        state.seat_greedily()
+    else:
+        raise Exception("Unknown initializer %s" % name)
+
+
+SEARCHERS = ['fast', 'greedy', 'annealing', 'best-of-k', 'tabu']
+
+
+def create_searcher(name='greedy', logger=None):
+    evaluator = TablePositionAgnosticClosnessEvaluator()
+    logger = logger if logger is not None else PrintLogger()
+    if name == 'greedy':
+        return SingleThreadedSearcher(ClosenessStepper(evaluator), SquareStateEvaluator(evaluator), logger)
+    if name == 'fast':
+        # Scored like the other searchers, so that masters can check its energies
+        return FastSearcher(score=SquareStateEvaluator(evaluator).evaluate, logger=logger)
+    if name == 'best-of-k':
+        return SingleThreadedSearcher(BestOfKStepper(), SquareStateEvaluator(evaluator), logger)
+    if name == 'annealing':
+        # Annealing keeps moving back to states it has already seen
+        return AnnealingSearcher(BlindStepper(), SquareStateEvaluator(evaluator, EnergyCache()), logger,
+                                 ReheatingCooling(AdaptiveCooling()))
+    if name == 'tabu':
+        return TabuSearcher(BlindStepper(), IncrementalSquareStateEvaluator(), logger)
+    raise Exception("Unknown searcher %s" % name)
+
+
+class IncrementalSearcher(Searcher):
+    """
+    Greedy search on a single state using the delta() API of an incremental
+    state evaluator, so that no step needs a full closeness recompute.
+    """
+
+    def __init__(self, state_evaluator, logger):
+        self.state_evaluator = state_evaluator
+        self.logger = logger
+
+    def log(self, msg):
+        self.logger.log(msg)
+
+    def search(self, start, n=10000):
+        self.log("Searching... ")
+        state = start.copy()
+        index = MoveIndex(state)
+
+        e = self.state_evaluator.evaluate(state)
+        for t in range(n):
+            i, j, p1, p2 = index.sample()
+            delta = self.state_evaluator.delta(state, i, j, p1, p2)
+            if delta < 0:
+                self.state_evaluator.swap(state, i, j, p1, p2)
+                self.state_evaluator.commit(state)
+                e = self.state_evaluator.evaluate(state)
                 self.log("New best state energy: " + str(e))
         self.log("Done")
         return state, e
@@ -322,40 +1258,71 @@ def dump(state):
     """
     @type state: State
     """
-    result = StringIO()
+    columns, persons = _nonzero(state.seating.transpose())
+    bounds = numpy.searchsorted(columns, numpy.arange(state.seating.shape[1] + 1))
+
+    result = []
     for m, (i, j) in enumerate(state.group_indexes):
-        result.write("# %s\n" % state.group_names[m])
+        result.append("# %s\n" % state.group_names[m])
         for p in range(i, j):
-            result.write("   %s\n" % (numpy.where(state.seating[:, p] == 1)[0]))
-    return result.getvalue()
+            result.append("   %s\n" % _format_indexes(persons[bounds[p]:bounds[p + 1]]))
+    return "".join(result)
 
 
-def report(state):
+def _nonzero(n):
     """
-    @type state: State
+    Rows and columns of the ones in a dense or scipy.sparse 0/1 matrix, in
+    row major order.
     """
-    result = StringIO()
+    if hasattr(n, 'tocoo'):
+        n = n.tocoo()
+        keep = n.data == 1
+        rows, cols = n.row[keep], n.col[keep]
+        order = numpy.lexsort((cols, rows))
+        return rows[order], cols[order]
+    return numpy.nonzero(n == 1)
 
-    attendance = numpy.dot(state.seating.transpose(), state.seating)
 
-    for group_name, (i, j) in zip(state.group_names, state.group_indexes):
-        if i + 1 == j:
-            continue
-        result.write("%s\n" % group_name)
+def _format_indexes(indexes):
+    """
+    str() of an array of non-negative integers, built directly when it fits
+    on one line.
+    """
+    if not len(indexes):
+        return str(indexes)
+    width = len(str(indexes[-1]))
+    line = "[%s]" % " ".join(str(index).rjust(width) for index in indexes)
+    if len(line) > 70:
+        return str(indexes)
+    return line
 
-        cnt = 0
-        for table in range(i, j):
-            result.write("  %s\n" % cnt)
 
-            for inner_group_name, (k, l) in zip(state.group_names, state.group_indexes):
-                if k + 1 != l:
-                    continue
-                n = attendance[i+cnt][k]
-                if n > 0:
-                    result.write("    %s: %d\n" % (inner_group_name, n))
-            cnt += 1
+def report(state):
+    """
+    @type state: State
+    """
+    meals = [(group_name, i, j) for group_name, (i, j) in zip(state.group_names, state.group_indexes) if i + 1 != j]
+    groups = [(group_name, k) for group_name, (k, l) in zip(state.group_names, state.group_indexes) if k + 1 == l]
+
+    # Attendance of every group at every table
+    tables = [table for _, i, j in meals for table in range(i, j)]
+    attendance = _dot(state.seating[:, tables].transpose(), state.seating[:, [k for _, k in groups]])
+    if hasattr(attendance, 'toarray'):
+        attendance = attendance.toarray()
+    rows, cols = numpy.nonzero(attendance > 0)
+    lines = ["    %s: %d\n" % (groups[g][0], attendance[r, g]) for r, g in zip(rows, cols)]
+    bounds = numpy.searchsorted(rows, numpy.arange(len(tables) + 1))
+
+    result = []
+    row = 0
+    for group_name, i, j in meals:
+        result.append("%s\n" % group_name)
+        for cnt in range(j - i):
+            result.append("  %s\n" % cnt)
+            result.extend(lines[bounds[row]:bounds[row + 1]])
+            row += 1
 
-    return result.getvalue()
+    return "".join(result)
 
 
 class PrintLogger(object):
@@ -366,6 +1333,11 @@ class PrintLogger(object):
         print msg
 
 
+class NullLogger(object):
+    def log(self, msg):
+        pass
+
+
 def optimize(start):
     """
     @type start: State
@@ -381,28 +1353,86 @@ def optimize(start):
     return state
 
 
-def stats(state):
+def stats(state, limit=None, offset=0, threshold=1):
     """
+    Pairs seated together at more than threshold meals as ("A-B", meal
+    closeness, group closeness), closest first. With limit, only the pairs
+    from offset to offset + limit are sorted and returned.
+
     @type state: State
     """
+    return list(iter_stats(state, limit, offset, threshold))
 
-    is_meal = [1 if i + 1 != j else 0 for i, j in state.group_indexes for _ in range(i, j)]
-    meal_placements = state.seating * numpy.array([is_meal] * state.persons)
-    meal_closeness = numpy.dot(meal_placements * state.weights, meal_placements.transpose())
 
-    is_group = [1 if i + 1 == j else 0 for i, j in state.group_indexes for _ in range(i, j)]
-    group_placements = state.seating * numpy.array([is_group] * state.persons)
-    group_closeness = numpy.dot(group_placements * state.weights, group_placements.transpose())
+def iter_stats(state, limit=None, offset=0, threshold=1, page_size=10000):
+    """
+    Like stats, but yields the pairs lazily, looking up page_size group
+    closenesses at a time.
 
-    result = []
-    for i in range(state.persons):
-        for j in range(state.persons):
-            if i < j:
-                result.append((i, j, meal_closeness[i, j], group_closeness[i, j]))
+    @type state: State
+    """
+    weighted = state.weighted_seating()
+
+    meal_columns = [c for i, j in state.group_indexes if i + 1 != j for c in range(i, j)]
+    meal_closeness = _dot(weighted[:, meal_columns], state.seating[:, meal_columns].transpose())
+    rows, cols, meal_values = _upper_pairs(meal_closeness, threshold)
+    del meal_closeness
+
+    group_columns = [c for i, j in state.group_indexes if i + 1 == j for c in range(i, j)]
+    group_weighted = weighted[:, group_columns]
+    group_seating = state.seating[:, group_columns]
+
+    if limit is None:
+        order = numpy.argsort(-meal_values, kind='mergesort')[offset:]
+    else:
+        order = _top(meal_values, offset + limit)[offset:]
+
+    for start in range(0, len(order), page_size):
+        page = order[start:start + page_size]
+        group_values = _pair_sums(group_weighted, group_seating, rows[page], cols[page])
+        for k, group_value in zip(page, group_values):
+            yield "%s-%s" % (state.names[rows[k]], state.names[cols[k]]), meal_values[k], group_value
 
-    result.sort(key=itemgetter(2), reverse=True)
 
-    return [("%s-%s" % (state.names[i], state.names[j]), meal_closeness, group_closeness) for i, j, meal_closeness, group_closeness in result if meal_closeness > 1]
+def _top(values, k):
+    """
+    Indexes of the k largest values, largest first and ties in index order,
+    as the first k of a stable sort would give.
+    """
+    if k >= len(values):
+        return numpy.argsort(-values, kind='mergesort')
+    if k <= 0:
+        return numpy.zeros(0, dtype=int)
+    kth = values[numpy.argpartition(-values, k - 1)[k - 1]]
+    above = numpy.flatnonzero(values > kth)
+    ties = numpy.flatnonzero(values == kth)[:k - len(above)]
+    chosen = numpy.concatenate([above, ties])
+    chosen.sort()
+    return chosen[numpy.argsort(-values[chosen], kind='mergesort')]
+
+
+def _pair_sums(a, b, rows, cols):
+    """
+    The sums of a[rows[k]] * b[cols[k]] for dense or scipy.sparse a and b.
+    """
+    if hasattr(a, 'multiply'):
+        return numpy.asarray(a[rows].multiply(b[cols]).sum(axis=1)).ravel()
+    return (a[rows] * b[cols]).sum(axis=1)
+
+
+def _upper_pairs(n, threshold):
+    """
+    Rows, columns and values of the entries above the diagonal of a dense or
+    scipy.sparse matrix that are greater than threshold, in row major order.
+    """
+    if hasattr(n, 'tocoo'):
+        n = n.tocoo()
+        keep = (n.row < n.col) & (n.data > threshold)
+        rows, cols, values = n.row[keep], n.col[keep], n.data[keep]
+        order = numpy.lexsort((cols, rows))
+        return rows[order], cols[order], values[order]
+    rows, cols = numpy.nonzero(numpy.triu(n > threshold, 1))
+    return rows, cols, n[rows, cols]
 
 
 def main():
@@ -1,78 +1,273 @@
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import shutil
+import tempfile
+import threading
+import time
+from urlparse import urlparse, parse_qs
 
-from excel_format import write_excel
-from seating import State, dump, report
-from text_format import write_text
+import simplejson
+
+from excel_format import write_xlsx
+from metrics import Metrics
+from searchresult import SearchResult, plain
+from seating import State, dump, report, stats
+from statediff import apply_swaps
+from text_format import iter_text
+from wire import CONTENT_TYPE, RESULT_CONTENT_TYPE, StaticRegistry, UnknownStatic, encode_state, decode_state
+
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
 
 
 class SeatingMaster(object):
 
     class RequestHandler(BaseHTTPRequestHandler):
         def do_GET(self):
-            response = self.server.dispatcher('GET', self.path, None)
-            self.send_response(200)
-            self.send_header("content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(response.encode('utf8') if response is not None else '')
+            response = self.server.dispatcher('GET', self.path, None, self.headers)
+            self._respond("application/json", response)
 
         def do_POST(self):
             data = self.rfile.read(int(self.headers.getheader('Content-Length')))
-            response = self.server.dispatcher('POST', self.path, data)
-            self.send_response(200)
-            self.send_header("content-type", "text/plain")
+            response = self.server.dispatcher('POST', self.path, data, self.headers)
+            self._respond("text/plain", response)
+
+        def _respond(self, content_type, response):
+            headers = {}
+            status = 200
+            if isinstance(response, tuple):
+                content_type, body = response[:2]
+                headers = response[2] if len(response) > 2 else headers
+                status = response[3] if len(response) > 3 else status
+            else:
+                body = response.encode('utf8') if response is not None else ''
+            self.send_response(status)
+            self.send_header("content-type", content_type)
+            for key, value in headers.items():
+                self.send_header(key, value)
             self.end_headers()
-            self.wfile.write(response.encode('utf8') if response is not None else '')
+            if hasattr(body, 'read'):
+                # Stream file objects in chunks
+                try:
+                    shutil.copyfileobj(body, self.wfile)
+                finally:
+                    body.close()
+            elif hasattr(body, 'next'):
+                # and generators chunk by chunk
+                for chunk in body:
+                    self.wfile.write(chunk.encode('utf8') if isinstance(chunk, unicode) else chunk)
+            else:
+                self.wfile.write(body)
+
+    class SeatingServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
 
-    class SeatingServer(HTTPServer):
         def __init__(self, dispatcher, *args, **kwargs):
             self.dispatcher = dispatcher
             HTTPServer.__init__(self, *args, **kwargs)
 
-    def __init__(self, state_keeper, server_address, state_evaluator):
-        def dispatcher(method, path, data):
+    def __init__(self, state_keeper, server_address, state_evaluator=None, rebase=True, trace=None,
+                 checkpointer=None):
+        def dispatcher(method, path, data, headers):
+            slave = headers.getheader('X-Slave-Id') if headers is not None else None
+            if method == 'POST' and slave is not None and headers.getheader('X-Slave-Metrics'):
+                self._seen(slave, metrics=simplejson.loads(headers.getheader('X-Slave-Metrics')))
             if method == 'GET' and path == '/get_best_state':
-                return self.get_best_state()
+                return self.get_best_state(binary=CONTENT_TYPE in (headers.getheader('Accept') or ''))
+            if method == 'GET' and path.startswith('/static/'):
+                return self.static(path[len('/static/'):])
             if method == 'GET' and path =='/dump':
                 return self.dump()
             if method == 'GET' and path =='/export':
                 return self.export()
             if method == 'GET' and path == '/excel':
                 return self.excel()
+            if method == 'GET' and path == '/metrics':
+                return self.get_metrics()
+            if method == 'GET' and urlparse(path).path == '/stats':
+                query = parse_qs(urlparse(path).query)
+                return self.stats(offset=int(query.get('offset', [0])[0]),
+                                  limit=int(query.get('limit', [1000])[0]),
+                                  threshold=int(query.get('threshold', [1])[0]))
             if method == 'POST' and path == '/report_state':
-                return self.report_state(data)
+                return self.report_state(data, binary=headers.getheader('Content-Type') == CONTENT_TYPE, slave=slave)
+            if method == 'POST' and path == '/report_result':
+                return self.report_result(data, binary=headers.getheader('Content-Type') == RESULT_CONTENT_TYPE,
+                                          slave=slave)
+            if method == 'POST' and path == '/report_swaps':
+                return self.report_swaps(data, slave=slave)
 
         self.state_evaluator = state_evaluator
 
         self._server = SeatingMaster.SeatingServer(dispatcher, server_address, SeatingMaster.RequestHandler)
         self.state_keeper = state_keeper
+        self.registry = StaticRegistry()
+        self.rebase = rebase
+        self._snapshot = (None, None, None)
         self.keep_running = False
+        self.metrics = Metrics()
+        self.trace = trace
+        self.checkpointer = checkpointer
+        self._slaves = {}
+        self._slaves_lock = threading.Lock()
 
     def dump(self):
         state = self.state_keeper.get_current_state()
         return dump(state) + u"\n%s\n" % (u"#"*80,) + report(state)
 
     def export(self):
-        return write_text(self.state_keeper.get_current_state())
+        return "text/plain; charset=utf-8", iter_text(self.state_keeper.get_current_state())
 
     def excel(self):
-        return write_excel(self.state_keeper.get_current_state())
+        """
+        The current state as .xlsx, spooled to a temporary file and streamed
+        from there.
+        """
+        out = tempfile.TemporaryFile()
+        write_xlsx(self.state_keeper.get_current_state(), out)
+        size = out.tell()
+        out.seek(0)
+        return XLSX_CONTENT_TYPE, out, {'Content-Length': str(size)}
 
-    def get_best_state(self):
-        state = self.state_keeper.get_current_state()
-        if state is not None:
-            return state.to_json()
-        else:
+    def stats(self, offset=0, limit=1000, threshold=1):
+        """
+        A page of the closest pairs in the current state.
+        """
+        pairs = stats(self.state_keeper.get_current_state(), limit, offset, threshold)
+        return "application/json", simplejson.dumps({
+            "offset": offset,
+            "pairs": [(pair, plain(meal), plain(group)) for pair, meal, group in pairs],
+        })
+
+    def get_best_state(self, binary=False):
+        state, version = self.state_keeper.get_current()
+        if state is None:
             return 'None'
+        headers = {'X-State-Version': str(version)}
+        if binary:
+            return CONTENT_TYPE, self._encoded(state, 2, lambda: encode_state(state, self.registry)), headers
+        return "application/json", self._encoded(state, 1, state.to_json), headers
+
+    def get_metrics(self):
+        """
+        Counters and timers of the master, and per slave its submissions, the
+        seconds since it was last heard from and the metrics it last reported.
+        """
+        now = time.time()
+        with self._slaves_lock:
+            slaves = dict((slave, dict(values, idle=now - values['last_seen']))
+                          for slave, values in self._slaves.items())
+        return "application/json", simplejson.dumps({
+            "energy": plain(self.state_keeper.get_current_energy()),
+            "version": self.state_keeper.get_current()[1],
+            "master": self.metrics.snapshot(),
+            "slaves": slaves,
+        })
+
+    def _encoded(self, state, index, encode):
+        # Accepted states are never modified, so their encodings can be shared
+        # by all requests until the next state is accepted.
+        snapshot = self._snapshot
+        if snapshot[0] is not state:
+            snapshot = (state, None, None)
+        if snapshot[index] is None:
+            snapshot = list(snapshot)
+            with self.metrics.timer('master.encode'):
+                snapshot[index] = encode()
+            snapshot = tuple(snapshot)
+            self._snapshot = snapshot
+        return snapshot[index]
+
+    def static(self, static_id):
+        try:
+            return 'application/octet-stream', self.registry.blob(static_id.decode('hex'))
+        except (UnknownStatic, TypeError):
+            return 'text/plain', 'Unknown static data', {}, 404
+
+    def report_state(self, data, binary=False, slave=None):
+        with self.metrics.timer('master.decode'):
+            if binary:
+                try:
+                    state = decode_state(data, self.registry)
+                except UnknownStatic:
+                    return self._discard(slave)
+            else:
+                state = State.from_json(data)
+        return self._challenge(SearchResult(state), slave)
+
+    def report_result(self, data, binary=False, slave=None):
+        with self.metrics.timer('master.decode'):
+            if binary:
+                try:
+                    result = SearchResult.from_bytes(data, self.registry)
+                except UnknownStatic:
+                    return self._discard(slave)
+            else:
+                result = SearchResult.from_json(data)
+        return self._challenge(result, slave)
+
+    def report_swaps(self, data, slave=None):
+        """
+        Swaps made by a slave on the state with version base_version. Swaps
+        against an older version are applied to the current state when
+        rebasing, and then their claimed energy no longer holds.
+        """
+        with self.metrics.timer('master.decode'):
+            values = simplejson.loads(data)
+            state, version = self.state_keeper.get_current()
+            energy = values.get('energy')
+            if values['base_version'] != version:
+                if not self.rebase:
+                    return self._discard(slave)
+                energy = None
+            state = apply_swaps(state, values['swaps'])
+        if state is None:
+            return self._discard(slave)
+        return self._challenge(SearchResult(state, energy), slave)
+
+    def _challenge(self, result, slave=None):
+        with self.metrics.timer('master.challenge'):
+            accepted = self.state_keeper.challenge_result(result)
+        if not accepted:
+            return self._discard(slave)
+        energy = self.state_keeper.get_current_energy()
+        print "Energy of current state:", energy
+        if self.trace is not None:
+            self.trace.record(energy)
+        if self.checkpointer is not None:
+            self.checkpointer.update(self.state_keeper)
+        self.metrics.count('master.accepted')
+        self._seen(slave, accepted=1)
+        return 'Accepted'
+
+    def _discard(self, slave):
+        self.metrics.count('master.discarded')
+        self._seen(slave, discarded=1)
+        return 'Discarded'
 
-    def report_state(self, data):
-        state = State.from_json(data)
-        if self.state_keeper.challenge_state(state):
-            print "Energy of current state:", self.state_evaluator.evaluate(state)
-            return 'Accepted'
-        else:
-            return 'Discarded'
+    def _seen(self, slave, accepted=0, discarded=0, metrics=None):
+        if slave is None:
+            return
+        with self._slaves_lock:
+            values = self._slaves.setdefault(slave, {"accepted": 0, "discarded": 0, "metrics": None})
+            values["accepted"] += accepted
+            values["discarded"] += discarded
+            values["last_seen"] = time.time()
+            if metrics is not None:
+                values["metrics"] = metrics
 
     def run(self):
+        # Each request is handled in its own thread. Waiting for the next one
+        # times out every second, so that an accepted state is checkpointed
+        # once the interval has passed even when no more results come in.
         self.keep_running = True
-        while self.keep_running:
-            self._server.handle_request()
+        if self.checkpointer is not None:
+            self._server.timeout = min(self.checkpointer.interval, 1.0)
+        try:
+            while self.keep_running:
+                self._server.handle_request()
+                if self.checkpointer is not None:
+                    self.checkpointer.update(self.state_keeper)
+        finally:
+            if self.checkpointer is not None:
+                self.checkpointer.update(self.state_keeper, force=True)
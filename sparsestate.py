@@ -0,0 +1,156 @@
+import numpy
+import scipy.sparse
+
+from seating import State, TablePositionAgnosticClosnessEvaluator, MoveIndex, greedy_tables
+
+
+class SparseState(State):
+    """
+    State backed by scipy.sparse matrices, for events where the one-hot
+    seating matrix is almost all zeros.
+
+    seating and fixed are CSR matrices, geometry is the CSC transpose of
+    seating sharing its buffers, and weights is a diagonal matrix of column
+    weights, so per person weights are not kept.
+    """
+
+    def __init__(self, names=None, group_names=None, group_indexes=None, group_weights=None, seating=None, weights=None, fixed=None, geometry=None):
+        seating = scipy.sparse.csr_matrix(seating)
+        seating.sort_indices()
+        if weights is None:
+            group_weights = group_weights if group_weights else [1] * len(group_indexes)
+            column_weights = [weight for (i, j), weight in zip(group_indexes, group_weights) for _ in range(i, j)]
+            weights = scipy.sparse.diags(column_weights, format='csr', dtype=seating.dtype)
+        fixed = scipy.sparse.csr_matrix(fixed if fixed is not None else seating.shape, dtype=bool)
+
+        super(SparseState, self).__init__(names=names,
+                                          group_names=group_names,
+                                          group_indexes=group_indexes,
+                                          group_weights=group_weights,
+                                          seating=seating,
+                                          weights=weights,
+                                          fixed=fixed,
+                                          geometry=seating.transpose())
+
+    def __eq__(self, other):
+        if type(other) != SparseState:
+            return False
+        return (self.names == other.names and
+                self.group_names == other.group_names and
+                self.group_indexes == other.group_indexes and
+                self.group_weights == other.group_weights and
+                self.seating.shape == other.seating.shape and
+                self.hash() == other.hash() and
+                (self.seating != other.seating).nnz == 0 and
+                (self.fixed != other.fixed).nnz == 0)
+
+    @staticmethod
+    def from_state(state):
+        """
+        @type state: seating.State
+        """
+        return SparseState(names=state.names,
+                           group_names=state.group_names,
+                           group_indexes=state.group_indexes,
+                           group_weights=state.group_weights,
+                           seating=state.seating,
+                           fixed=state.fixed)
+
+    def to_state(self):
+        seating = self.seating.toarray()
+        return State(names=self.names,
+                     group_names=self.group_names,
+                     group_indexes=self.group_indexes,
+                     group_weights=self.group_weights,
+                     seating=seating,
+                     fixed=self.fixed.toarray(),
+                     geometry=seating.copy().transpose())
+
+    @staticmethod
+    def from_json(json):
+        return SparseState.from_state(State.from_json(json))
+
+    def to_json(self):
+        return self.to_state().to_json()
+
+    def copy(self):
+        return self._copy_hash(SparseState(names=self.names,
+                                           group_names=self.group_names,
+                                           group_indexes=self.group_indexes,
+                                           group_weights=self.group_weights,
+                                           seating=self.seating.copy(),
+                                           weights=self.weights,
+                                           fixed=self.fixed))
+
+    def weighted_seating(self):
+        return self.seating.dot(self.weights)
+
+    def _position(self, p, i, j):
+        """
+        Index into seating.indices of the table person p has in meal i:j.
+        """
+        start, end = self.seating.indptr[p], self.seating.indptr[p + 1]
+        columns = self.seating.indices[start:end]
+        found = numpy.where((columns >= i) & (columns < j))[0]
+        return start + found[0] if len(found) else None
+
+    def can_swap(self, i, j, p1, p2):
+        k1 = self._position(p1, i, j)
+        if k1 is None:
+            return False
+        k2 = self._position(p2, i, j)
+        if k2 is None:
+            return False
+        indices = self.seating.indices
+        if self.fixed[p1, indices[k1]] or self.fixed[p2, indices[k2]]:
+            return False
+        return True
+
+    def swap(self, i, j, p1, p2, check=True):
+        if check and not self.can_swap(i, j, p1, p2):
+            return False
+        # Each person has exactly one entry within i:j, so the swap only moves
+        # column indices around and keeps every row sorted. The geometry shares
+        # the same buffers and follows along.
+        k1, k2 = self._position(p1, i, j), self._position(p2, i, j)
+        indices = self.seating.indices
+        self._swap_hash(p1, indices[k1], p2, indices[k2])
+        indices[k1], indices[k2] = indices[k2], indices[k1]
+        return True
+
+    def shuffle(self):
+        # Every movable person has exactly one entry within i:j, so permuting
+        # those column indices keeps the rows sorted, like swap.
+        indices = self.seating.indices
+        rows = numpy.repeat(numpy.arange(self.persons), numpy.diff(self.seating.indptr))
+        movable = numpy.zeros(self.persons, dtype=bool)
+        for i, j, persons in MoveIndex(self).choices:
+            movable[:] = False
+            movable[persons] = True
+            entries = numpy.flatnonzero((indices >= i) & (indices < j) & movable[rows])
+            indices[entries] = numpy.random.permutation(indices[entries])
+        self._zobrist = None
+
+    def seat_greedily(self):
+        # As in shuffle, but with the tables of greedy_tables
+        indices = self.seating.indices
+        rows = numpy.repeat(numpy.arange(self.persons), numpy.diff(self.seating.indptr))
+        movable = numpy.zeros(self.persons, dtype=bool)
+        for i, j, persons, tables in greedy_tables(self):
+            movable[:] = False
+            movable[persons] = True
+            entries = numpy.flatnonzero((indices >= i) & (indices < j) & movable[rows])
+            indices[entries] = tables
+        self._zobrist = None
+
+
+class SparseClosenessEvaluator(TablePositionAgnosticClosnessEvaluator):
+    """
+    Closeness as a CSR matrix where only pairs closer than 1 are kept.
+    """
+
+    def closeness(self, state):
+        result = scipy.sparse.csr_matrix(super(SparseClosenessEvaluator, self).closeness(state))
+        result.data[result.data <= 1] = 0
+        result.eliminate_zeros()
+        return result
@@ -0,0 +1,43 @@
+import numpy
+
+
+def seating_swaps(base, state):
+    """
+    Swaps (i, j, p1, p2) that turn the seating of base into that of state,
+    where state was reached from base by swaps.
+
+    @type base: seating.State
+    @type state: seating.State
+    """
+    swaps = []
+    for i, j in base.group_indexes:
+        if i + 1 == j:
+            continue
+        present = base.seating[:, i:j].any(axis=1)
+        current = numpy.argmax(base.seating[:, i:j], axis=1)
+        target = numpy.argmax(state.seating[:, i:j], axis=1)
+        moved = numpy.where(present & (current != target))[0]
+
+        for p1 in moved:
+            while current[p1] != target[p1]:
+                # Someone misplaced sits where p1 should go, preferably someone
+                # who should go where p1 sits now
+                candidates = moved[(current[moved] == target[p1]) & (current[moved] != target[moved])]
+                best = candidates[target[candidates] == current[p1]]
+                p2 = best[0] if len(best) else candidates[0]
+                current[p1], current[p2] = current[p2], current[p1]
+                swaps.append((i, j, int(p1), int(p2)))
+    return swaps
+
+
+def apply_swaps(state, swaps):
+    """
+    A copy of state with swaps applied, or None if any of them is not allowed.
+
+    @type state: seating.State
+    """
+    result = state.copy()
+    for i, j, p1, p2 in swaps:
+        if not result.swap(i, j, p1, p2):
+            return None
+    return result
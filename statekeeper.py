@@ -1,5 +1,8 @@
+import threading
 from abc import ABCMeta, abstractmethod
 
+from searchresult import SearchResult
+
 
 class StateEvaluator(object):
     __metaclass__ = ABCMeta
@@ -8,21 +11,66 @@ class StateEvaluator(object):
     def challenge(self):
         pass
 
+    @abstractmethod
+    def energy(self, result):
+        pass
+
+    @abstractmethod
+    def challenge_result(self, result1, result2):
+        pass
+
 
 class StateKeeper(object):
-    def __init__(self, challenge_evaluator, state=None):
-        self._current_state = state
+    def __init__(self, challenge_evaluator, state=None, energy=None, version=0):
+        self._current = SearchResult(state, energy) if state is not None else None
         assert issubclass(type(challenge_evaluator), StateEvaluator)
         self.challenge_evaluator = challenge_evaluator
+        self._lock = threading.Lock()
+        self._version = version
 
     def get_current_state(self):
-        return self._current_state
+        current = self._current
+        return current.state if current is not None else None
+
+    def get_current(self):
+        """
+        The current state together with its version, which is bumped every
+        time a new state is accepted.
+        """
+        with self._lock:
+            return self.get_current_state(), self._version
+
+    def get_current_result(self):
+        """
+        The current SearchResult, with its energy, together with its version.
+        """
+        with self._lock:
+            return self._trusted_current(), self._version
+
+    def get_current_energy(self):
+        with self._lock:
+            current = self._trusted_current()
+            return current.energy if current is not None else None
 
     def challenge_state(self, state):
-        prev_state = self._current_state
-        if self._current_state is None:
-            self._current_state = state
-        else:
-            self._current_state = self.challenge_evaluator.challenge(self._current_state, state)
-        return prev_state != self._current_state
+        return self.challenge_result(SearchResult(state))
+
+    def challenge_result(self, result):
+        with self._lock:
+            current = self._trusted_current()
+            if current is None:
+                energy = self.challenge_evaluator.energy(result)
+                if energy is not None:
+                    self._current = SearchResult(result.state, energy)
+            else:
+                self._current = self.challenge_evaluator.challenge_result(current, result)
+            if self._current is current:
+                return False
+            self._version += 1
+            return True
 
+    def _trusted_current(self):
+        current = self._current
+        if current is not None and current.energy is None:
+            current = self._current = SearchResult(current.state, self.challenge_evaluator.energy(current))
+        return current
@@ -1,10 +1,32 @@
 from io import BytesIO
-from excel_format import write_excel, read_excel
+from excel_format import write_excel, read_excel, write_xlsx
 import numpy
 import pytest
+import random
+import requests
 from seating import start_seating, dump, State, TablePositionAgnosticClosnessEvaluator, SingleThreadedSearcher, \
-    ClosenessStepper, SquareStateEvaluator, PrintLogger, report, stats, energy_sum, fast_search, energy_sum_of_square
+    ClosenessStepper, SquareStateEvaluator, PrintLogger, report, stats, energy_sum, fast_search, energy_sum_of_square, \
+    IncrementalSquareStateEvaluator, IncrementalSumOfSquareStateEvaluator, IncrementalSearcher, AnnealingSearcher, \
+    BlindStepper, GeometricCooling, AdaptiveCooling, ReheatingCooling, create_searcher, NullLogger, BestOfKStepper, \
+    FastSearcher, iter_stats, EnergyCache, TabuSearcher, MoveIndex, SEARCHERS, IncrementalClosenessEvaluator
 from text_format import write_text, read_text
+from compactstate import CompactState
+from sparsestate import SparseState, SparseClosenessEvaluator
+from parallel import ParallelSearcher, ReplicaExchangeSearcher, _rounds
+from wire import StaticRegistry, encode_state, decode_state
+from server import SeatingMaster
+from client import SeatingSlave
+from statekeeper import StateKeeper
+from evaluators import HillClimber, ALWAYS, NEVER
+from searchresult import SearchResult
+from checkpoint import Checkpointer, load_checkpoint
+from benchmark import run_case
+from metrics import METRICS
+from statediff import seating_swaps, apply_swaps
+import simplejson
+import threading
+import time
+from openpyxl import load_workbook
 from xlrd import open_workbook
 from xlutils.copy import copy
 
@@ -29,6 +51,82 @@ def test_swap():
     _assert_same_state(initial, state)
     assert initial == state
     assert not initial != state
+    state.swap(2, 4, 0, 1)
+    assert initial != state
+
+
+def test_shuffle(initial):
+    for state in [initial.copy(), SparseState.from_state(initial)]:
+        hash_before = state.hash()
+        state.shuffle()
+        shuffled = state.to_state() if isinstance(state, SparseState) else state
+        assert numpy.array_equal(shuffled.seating.sum(axis=0), initial.seating.sum(axis=0))
+        assert numpy.array_equal(shuffled.seating * shuffled.fixed, initial.seating * initial.fixed)
+        assert numpy.array_equal(shuffled.geometry, shuffled.seating.transpose())
+        assert state.hash() == _unhashed(shuffled).hash()
+        assert state.hash() != hash_before or numpy.array_equal(shuffled.seating, initial.seating)
+
+
+def test_seat_greedily(initial):
+    evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    numpy.random.seed(0)
+    state = initial.copy()
+    state.seat_greedily()
+    assert numpy.array_equal(state.seating.sum(axis=0), initial.seating.sum(axis=0))
+    assert numpy.array_equal(state.seating.sum(axis=1), initial.seating.sum(axis=1))
+    assert numpy.array_equal(state.seating * state.fixed, initial.seating * initial.fixed)
+    assert numpy.array_equal(state.geometry, state.seating.transpose())
+    assert state.hash() == _unhashed(state).hash()
+
+    numpy.random.seed(0)
+    sparse = SparseState.from_state(initial)
+    sparse.seat_greedily()
+    assert numpy.array_equal(sparse.to_state().seating, state.seating)
+    assert sparse.hash() == state.hash()
+
+    numpy.random.seed(0)
+    large = start_seating(persons=150, meals=6, groups=1)
+    shuffled = large.copy()
+    shuffled.shuffle()
+    large.seat_greedily()
+    assert evaluator.evaluate(large) < evaluator.evaluate(shuffled)
+
+
+def test_hash(initial):
+    initial.hash()
+    state = initial.copy()
+    sparse = SparseState.from_state(initial)
+    sparse.hash()
+    for _ in range(20):
+        i, j = random.choice([(i, j) for i, j in initial.group_indexes if i + 1 < j])
+        p1, p2 = numpy.random.choice(initial.persons, 2)
+        state.swap(i, j, p1, p2)
+        sparse.swap(i, j, p1, p2)
+    assert state.hash() == state.copy().hash() == _unhashed(state).hash()
+    assert sparse.hash() == state.hash() == SparseState.from_state(state).hash()
+    assert (state == initial) == numpy.array_equal(state.seating, initial.seating)
+
+
+def _unhashed(state):
+    return State.from_json(state.to_json())
+
+
+def test_energy_cache():
+    cache = EnergyCache(size=2)
+    evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator(), cache)
+    states = [start_seating() for _ in range(3)]
+    for state in states:
+        state.shuffle()
+    energies = [evaluator.evaluate(state) for state in states]
+    assert cache.get(states[0]) is None
+    assert cache.get(states[2]) == energies[2]
+    assert evaluator.evaluate(states[1].copy()) == energies[1]
+
+    before = METRICS.snapshot()['counters']
+    evaluator.flush_metrics()
+    after = METRICS.snapshot()['counters']
+    assert after['cache.hits'] - before.get('cache.hits', 0) == 2
+    assert after['cache.misses'] - before.get('cache.misses', 0) == 4
 
 
 def test_optimize():
@@ -44,6 +142,50 @@ def test_optimize():
     assert e2 < e1
 
 
+@pytest.mark.parametrize('schedule', [GeometricCooling(1000, 1),
+                                      AdaptiveCooling(),
+                                      ReheatingCooling(GeometricCooling(1000, 1), patience=10)])
+def test_annealing(schedule):
+    initial = start_seating()
+    evaluator = TablePositionAgnosticClosnessEvaluator()
+    searcher = AnnealingSearcher(
+        BlindStepper(),
+        SquareStateEvaluator(evaluator),
+        PrintLogger(),
+        schedule
+    )
+    state, e = searcher.search(initial, n=100)
+    assert e == SquareStateEvaluator(evaluator).evaluate(state)
+    assert e < SquareStateEvaluator(evaluator).evaluate(initial)
+
+
+def test_parallel_search():
+    initial = start_seating()
+    evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    searcher = ParallelSearcher(create_searcher('greedy', NullLogger()), workers=2, sync_interval=50)
+    state, e = searcher.search(initial, n=100)
+    assert e == evaluator.evaluate(state)
+    assert e < evaluator.evaluate(initial)
+
+    assert _rounds(100, 50) == [50, 50]
+    assert _rounds(120, 50) == [50, 50, 20]
+    assert _rounds(10, 50) == [10]
+    state, e = searcher.search(initial, n=10)
+    assert e == evaluator.evaluate(state)
+
+
+def test_replica_exchange():
+    initial = start_seating()
+    evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    searcher = ReplicaExchangeSearcher(BlindStepper(), evaluator, replicas=3, workers=2, exchange_interval=20)
+    state, e = searcher.search(initial, n=100)
+    assert e == evaluator.evaluate(state)
+    assert e < evaluator.evaluate(initial)
+    state, e = searcher.search(initial, n=5)
+    assert e == evaluator.evaluate(state)
+    assert numpy.array_equal(state.geometry, state.seating.transpose())
+
+
 def test_fast_search():
     initial = start_seating()
     score = energy_sum_of_square
@@ -52,6 +194,153 @@ def test_fast_search():
     assert e2 < e1
 
 
+@pytest.mark.parametrize('state_evaluator', [
+    SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator()),
+    IncrementalSquareStateEvaluator(),
+])
+def test_tabu_searcher(state_evaluator):
+    initial = start_seating()
+    initial.shuffle()
+    before = initial.copy()
+    evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    searcher = TabuSearcher(BlindStepper(), state_evaluator, NullLogger(), tenure=5, candidates=5)
+    state, e = searcher.search(initial, n=50)
+    _assert_same_state(before, initial)
+    assert e == evaluator.evaluate(state) < evaluator.evaluate(initial)
+
+
+def test_tabu_searcher_moves():
+    # Past the local minimum of a small instance, every move made still
+    # changes the seating
+    class Recording(IncrementalSquareStateEvaluator):
+        def swap(self, state, i, j, p1, p2):
+            before = state.seating.copy()
+            swapped = super(Recording, self).swap(state, i, j, p1, p2)
+            changed.append(swapped and not numpy.array_equal(before, state.seating))
+            return swapped
+
+    changed = []
+    initial = start_seating(persons=20, meals=3, groups=2, positions=4)
+    searcher = TabuSearcher(BlindStepper(), Recording(), NullLogger(), tenure=5, candidates=20)
+    searcher.search(initial, n=300)
+    assert changed and all(changed)
+
+
+def test_move_index(explicit_initial):
+    state = explicit_initial
+    index = MoveIndex(state)
+    # Bob is fixed in the first meal and Dave skips the second
+    assert [(i, j, list(persons)) for i, j, persons in index.choices] == [
+        (0, 2, [0, 2, 3]),
+        (2, 4, [0, 1, 2]),
+        (4, 6, [0, 1, 2, 3]),
+    ]
+    for _ in range(20):
+        assert state.can_swap(*index.sample())
+    assert MoveIndex.of(state.copy(), index) is index
+    assert MoveIndex.of(SparseState.from_state(state), index).choices[0][2].tolist() == [0, 2, 3]
+
+
+def test_fast_searcher():
+    initial = start_seating()
+    before = initial.copy()
+    improvements = []
+    searcher = FastSearcher(callback=lambda t, e: improvements.append(e), window=10, seconds=60)
+    state, e = searcher.search(initial, n=100)
+    _assert_same_state(before, initial)
+    assert e == energy_sum_of_square(state) == improvements[-1]
+    assert improvements == sorted(improvements, reverse=True)
+
+
+@pytest.mark.parametrize('name', SEARCHERS)
+def test_searcher_energy(name):
+    # Slaves report these energies to a master that checks them
+    initial = start_seating()
+    initial.shuffle()
+    state, e = create_searcher(name, NullLogger()).search(initial, n=20)
+    assert e == SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator()).evaluate(state)
+
+
+def test_incremental_evaluators():
+    state = start_seating()
+    state.shuffle()
+    square = IncrementalSquareStateEvaluator()
+    sum_of_square = IncrementalSumOfSquareStateEvaluator()
+    full = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    before = state.copy()
+
+    for _ in range(20):
+        i, j = 15, 30
+        p1, p2 = numpy.random.choice(state.persons, 2)
+        e = square.evaluate(state)
+        delta = square.delta(state, i, j, p1, p2)
+        assert square.swap(state, i, j, p1, p2)
+        assert square.evaluate(state) == e + delta == full.evaluate(state)
+
+    for _ in range(20):
+        square.undo(state)
+    assert square.evaluate(state) == full.evaluate(state)
+    _assert_same_state(before, state)
+
+    for _ in range(20):
+        p1, p2 = numpy.random.choice(state.persons, 2)
+        e = sum_of_square.evaluate(state)
+        delta = sum_of_square.delta(state, 0, 15, p1, p2)
+        assert sum_of_square.swap(state, 0, 15, p1, p2)
+        assert sum_of_square.evaluate(state) == e + delta == energy_sum_of_square(state)
+
+
+def test_swap_deltas():
+    state = start_seating()
+    state.shuffle()
+    p1s = numpy.random.choice(state.persons, 20)
+    p2s = numpy.random.choice(state.persons, 20)
+    deltas, _ = IncrementalClosenessEvaluator().deltas(state, 30, 45, p1s, p2s)
+    _, square_deltas = IncrementalClosenessEvaluator(weighted=False).deltas(state, 30, 45, p1s, p2s)
+
+    evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    e = evaluator._energy_sum(state)
+    for p1, p2, delta, square_delta in zip(p1s, p2s, deltas, square_deltas):
+        swapped = state.copy()
+        swapped.swap(30, 45, p1, p2)
+        assert evaluator._energy_sum(swapped) - e == delta
+        assert energy_sum_of_square(swapped) - energy_sum_of_square(state) == square_delta
+
+
+def test_best_of_k():
+    initial = start_seating()
+    evaluator = TablePositionAgnosticClosnessEvaluator()
+    searcher = SingleThreadedSearcher(BestOfKStepper(), SquareStateEvaluator(evaluator), PrintLogger())
+    _, e = searcher.search(initial, n=20)
+    assert e < SquareStateEvaluator(evaluator).evaluate(initial)
+
+    # The move made is the best of the k the stepper drew
+    random.seed(0)
+    numpy.random.seed(0)
+    i, j, p1, p2 = BestOfKStepper(k=8).propose(initial)
+    random.seed(0)
+    numpy.random.seed(0)
+    i, j, movable = random.choice(MoveIndex(initial).choices)
+    candidates = zip(numpy.random.choice(movable, 8), numpy.random.choice(movable, 8))
+    assert (p1, p2) in candidates
+    energy_sums = []
+    for q1, q2 in candidates:
+        swapped = initial.copy()
+        swapped.swap(i, j, q1, q2)
+        energy_sums.append(SquareStateEvaluator(evaluator)._energy_sum(swapped))
+    swapped = initial.copy()
+    swapped.swap(i, j, p1, p2)
+    assert SquareStateEvaluator(evaluator)._energy_sum(swapped) == min(energy_sums)
+
+
+def test_incremental_search():
+    initial = start_seating()
+    searcher = IncrementalSearcher(IncrementalSquareStateEvaluator(), PrintLogger())
+    state, e = searcher.search(initial, n=100)
+    assert e == SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator()).evaluate(state)
+    assert e < IncrementalSquareStateEvaluator().evaluate(initial)
+
+
 @pytest.fixture
 def explicit_initial():
     return read_text("""
@@ -102,24 +391,264 @@ def test_json(initial):
     _assert_same_state(initial, actual)
 
 
+def test_wire(initial):
+    sender, receiver = StaticRegistry(), StaticRegistry()
+    data = encode_state(initial, sender)
+    receiver.add(sender.blob(sender.register(initial)))
+    actual = decode_state(data, receiver)
+    _assert_same_state(initial, actual)
+    assert encode_state(actual, receiver) == data
+    assert len(data) < len(initial.to_json()) / 10
+
+    registry = StaticRegistry(size=2)
+    ids = set(registry.register(_unhashed(initial)) for _ in range(5))
+    assert ids == set([sender.register(initial)])
+    assert len(registry._ids) == 2
+
+
+def test_master_and_slave_binary():
+    evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    initial = start_seating()
+    master = SeatingMaster(StateKeeper(HillClimber(evaluator), state=initial), ('127.0.0.1', 0), evaluator)
+    thread = threading.Thread(target=master._server.serve_forever)
+    thread.start()
+
+    slave = SeatingSlave(*master._server.server_address, searcher=create_searcher('greedy', NullLogger()))
+    state = slave.get_best_state()
+    _assert_same_state(initial, state)
+    state, _ = slave.searcher.search(state, n=10)
+    slave.report_state(state)
+    excel = requests.get('http://%s:%s/excel' % master._server.server_address)
+    export = requests.get('http://%s:%s/export' % master._server.server_address)
+    unknown = requests.get('http://%s:%s/static/%s' % (master._server.server_address + ('00' * 20,)))
+    master._server.shutdown()
+    thread.join()
+    assert unknown.status_code == 404
+    _assert_same_state(state, master.state_keeper.get_current_state())
+    assert load_workbook(BytesIO(excel.content)).sheetnames == ['Groups', 'Tables', 'Placement', 'Statistics']
+    assert export.content == write_text(state)
+
+
+def test_search_result(initial):
+    result = SearchResult(initial, 42)
+    actual = SearchResult.from_json(result.to_json())
+    _assert_same_state(initial, actual.state)
+    assert actual.energy == 42
+
+    registry = StaticRegistry()
+    actual = SearchResult.from_bytes(result.to_bytes(registry), registry)
+    _assert_same_state(initial, actual.state)
+    assert actual.energy == 42
+    assert SearchResult.from_bytes(SearchResult(initial).to_bytes(registry), registry).energy is None
+
+
+def test_checkpoint(tmpdir):
+    evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    initial = start_seating()
+    better, e = create_searcher('greedy', NullLogger()).search(initial, n=100)
+    filename = str(tmpdir.join('checkpoint'))
+
+    keeper = StateKeeper(HillClimber(evaluator), state=initial)
+    checkpointer = Checkpointer(filename, interval=3600)
+    assert checkpointer.update(keeper)
+    assert keeper.challenge_state(better)
+    assert not checkpointer.update(keeper)
+    assert checkpointer.update(keeper, force=True)
+    assert tmpdir.listdir() == [tmpdir.join('checkpoint')]
+
+    state, energy, version = load_checkpoint(filename)
+    _assert_same_state(better, state)
+    assert (energy, version) == (e, 1)
+
+
+def test_master_checkpoints_when_quiet(tmpdir):
+    evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    initial = start_seating()
+    better, e = create_searcher('greedy', NullLogger()).search(initial, n=100)
+    filename = str(tmpdir.join('checkpoint'))
+
+    keeper = StateKeeper(HillClimber(evaluator), state=initial)
+    checkpointer = Checkpointer(filename, interval=0.5)
+    checkpointer.update(keeper)
+    master = SeatingMaster(keeper, ('127.0.0.1', 0), evaluator, checkpointer=checkpointer)
+    assert master._challenge(SearchResult(better, e)) == 'Accepted'
+    assert load_checkpoint(filename)[2] == 0
+
+    thread = threading.Thread(target=master.run)
+    thread.start()
+    time.sleep(2)
+    version = load_checkpoint(filename)[2]
+    master.keep_running = False
+    requests.get('http://%s:%s/metrics' % master._server.server_address)
+    thread.join()
+    assert version == 1
+
+
+def test_state_keeper_trusts_energies():
+    evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    initial = start_seating()
+    better, e = create_searcher('greedy', NullLogger()).search(initial, n=100)
+
+    keeper = StateKeeper(HillClimber(evaluator, ALWAYS), state=initial)
+    assert keeper.get_current_energy() == evaluator.evaluate(initial)
+    assert not keeper.challenge_result(SearchResult(better, e - 1))
+    assert keeper.challenge_result(SearchResult(better, e))
+    assert keeper.get_current_state() is better
+    assert not keeper.challenge_state(better)
+
+    keeper = StateKeeper(HillClimber(evaluator, NEVER), state=initial)
+    assert keeper.challenge_result(SearchResult(initial, 0))
+    assert keeper.get_current_energy() == 0
+
+
+def test_seating_swaps(initial):
+    state = initial.copy()
+    state.shuffle()
+    swaps = seating_swaps(initial, state)
+    _assert_same_state(state, apply_swaps(initial, swaps))
+    assert seating_swaps(state, state) == []
+
+
+def test_master_accepts_swaps():
+    evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    initial = start_seating()
+    master = SeatingMaster(StateKeeper(HillClimber(evaluator), state=initial), ('127.0.0.1', 0), evaluator)
+    thread = threading.Thread(target=master._server.serve_forever)
+    thread.start()
+
+    slave = SeatingSlave(*master._server.server_address, searcher=create_searcher('greedy', NullLogger()))
+    base = slave.get_best_state()
+    assert slave.version == 0
+    state, e = slave.searcher.search(base, n=100)
+    assert slave.report_swaps(0, seating_swaps(base, state), e).content == 'Accepted'
+    master.rebase = False
+    assert slave.report_swaps(0, seating_swaps(base, state), e).content == 'Discarded'
+    metrics = simplejson.loads(master.get_metrics()[1])
+    master._server.shutdown()
+    thread.join()
+    _assert_same_state(state, master.state_keeper.get_current_state())
+    assert master.state_keeper.get_current() == (master.state_keeper.get_current_state(), 1)
+    assert metrics['master']['counters'] == {'master.accepted': 1, 'master.discarded': 1}
+    assert metrics['slaves'][slave.slave_id]['accepted'] == 1
+    assert metrics['slaves'][slave.slave_id]['metrics']['counters']['search.steps'] >= 100
+
+
+def test_concurrent_master():
+    evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    initial = start_seating()
+    master = SeatingMaster(StateKeeper(HillClimber(evaluator), state=initial), ('127.0.0.1', 0), evaluator)
+    server = threading.Thread(target=master._server.serve_forever)
+    server.start()
+
+    results = []
+
+    def run_slave():
+        slave = SeatingSlave(*master._server.server_address, searcher=create_searcher('greedy', NullLogger()))
+        state, e = slave.searcher.search(slave.get_best_state(), n=10)
+        slave.report_result(SearchResult(state, e))
+        results.append(e)
+
+    slaves = [threading.Thread(target=run_slave) for _ in range(4)]
+    for slave in slaves:
+        slave.start()
+    for slave in slaves:
+        slave.join()
+    master._server.shutdown()
+    server.join()
+    assert evaluator.evaluate(master.state_keeper.get_current_state()) == min(results)
+
+
 def test_excel(initial):
     excel_content = write_excel(initial)
     actual = read_excel(excel_content)
     _assert_same_state(initial, actual)
 
 
+def test_xlsx(initial):
+    out = BytesIO()
+    write_xlsx(initial, out)
+    xlsx = load_workbook(BytesIO(out.getvalue()), read_only=True)
+    xls = open_workbook(file_contents=write_excel(initial))
+    assert xlsx.sheetnames == xls.sheet_names()
+    for sheet in xls.sheets():
+        rows = [[cell if cell is not None else '' for cell in row] for row in xlsx[sheet.name].values]
+        expected = [[int(cell) if isinstance(cell, float) else cell for cell in sheet.row_values(row)]
+                    for row in range(sheet.nrows)]
+        assert [row + [''] * (sheet.ncols - len(row)) for row in rows] == expected
+    _assert_same_state(initial, read_excel(out.getvalue()))
+
+
 def test_text_format(initial):
     text_content = write_text(initial)
     actual = read_text(text_content)
     print repr(actual)
     _assert_same_state(initial, actual)
 
+    out = BytesIO()
+    write_text(initial, out)
+    assert out.getvalue() == text_content
+    _assert_same_state(initial, read_text(BytesIO(text_content)))
+
+
+def test_compact_state(initial):
+    compact = CompactState.from_state(initial)
+    _assert_same_state(initial, compact.to_state())
+    assert CompactState.from_json(compact.to_json()) == compact
+    nobody = State(names=[], group_indexes=[[0, 2], [2, 3]], seating=numpy.zeros((0, 3), dtype=int))
+    for empty in [start_seating(meals=0), start_seating(groups=0), nobody]:
+        empty_compact = CompactState.from_state(empty)
+        assert CompactState.from_json(empty_compact.to_json()) == empty_compact
+    evaluator = TablePositionAgnosticClosnessEvaluator()
+    assert numpy.array_equal(compact.closeness(), evaluator.closeness(initial))
+
+    state = initial.copy()
+    compact = compact.copy()
+    for _ in range(10):
+        i, j = state.group_indexes[0]
+        p1, p2 = numpy.random.choice(state.persons, 2)
+        assert compact.swap(i, j, p1, p2) == state.swap(i, j, p1, p2)
+    _assert_same_state(state, compact.to_state())
+    assert numpy.array_equal(compact.closeness(), evaluator.closeness(state))
+
+
+def test_sparse_state(initial):
+    sparse = SparseState.from_state(initial)
+    _assert_same_state(initial, sparse.to_state())
+    assert SparseState.from_json(sparse.to_json()) == sparse
+
+    dense_evaluator = SquareStateEvaluator(TablePositionAgnosticClosnessEvaluator())
+    sparse_evaluator = SquareStateEvaluator(SparseClosenessEvaluator())
+    assert sparse_evaluator.evaluate(sparse) == dense_evaluator.evaluate(initial)
+    assert energy_sum(sparse) == energy_sum(initial)
+    assert stats(sparse) == stats(initial)
+    assert report(sparse) == report(initial)
+    assert dump(sparse) == dump(initial)
+
+    state = initial.copy()
+    sparse = sparse.copy()
+    for _ in range(10):
+        i, j = state.group_indexes[0]
+        p1, p2 = numpy.random.choice(state.persons, 2)
+        assert sparse.swap(i, j, p1, p2) == state.swap(i, j, p1, p2)
+    _assert_same_state(state, sparse.to_state())
+    assert sparse_evaluator.evaluate(sparse) == dense_evaluator.evaluate(state)
+
 
 def test_stats(explicit_initial):
     subject = explicit_initial
     print dump(subject)
     assert stats(subject) == [("Alice-Bob", 2, 17),
                               ("Charlie-Dave", 2, 42)]
+    assert stats(subject, limit=1, offset=1) == [("Charlie-Dave", 2, 42)]
+    assert stats(subject, threshold=2) == []
+
+
+def test_stats_pages(initial):
+    state = initial.copy()
+    state.shuffle()
+    everything = stats(state, threshold=0)
+    assert list(iter_stats(state, threshold=0, page_size=7)) == everything
+    assert stats(state, limit=25, offset=10, threshold=0) == everything[10:35]
 
 
 def test_excel_change_geometry():
@@ -219,3 +748,10 @@ Bar
   1
     Even: 2
 """
+
+
+def test_benchmark_failed_case():
+    result = run_case('engine', 'fast', None, 0, start='/nonexistent.txt')
+    assert result['exitcode'] != 0
+    result = run_case('evaluator', 'delta', 20, 0, steps=10, seconds=1)
+    assert result['calls'] == 10
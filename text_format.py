@@ -8,17 +8,27 @@ from seating import State
 
 def read_text(content):
     """
-    @type content: str
+    Reads a seating line by line from a string or a file object.
+
+    @type content: str | file
     """
+    lines = BytesIO(content) if isinstance(content, basestring) else content
 
     group_names = []
     group_weights = []
-    groups = []
+    group_indexes = []
 
-    group = []
-    position = []
+    # Person index (in order of appearance), column and fixed for every line
+    index_by_name = {}
+    persons = []
+    cols = []
+    fixed = []
 
-    for line in BytesIO(content):
+    matrix_col = 0
+    positions = 0
+    position = 0
+
+    for line in lines:
         if line.startswith('#'):
             name, weight_str = re.match(r"#\s*([^(]*)\s*(?:\((\d+)\))?", line.strip()).groups()
             group_names.append(name.strip())
@@ -26,50 +36,42 @@ def read_text(content):
             group_weights.append(weight)
 
             if position:
-                group.append(position)
-                position = []
-            if group:
-                groups.append(group)
-                group = []
+                positions += 1
+                position = 0
+            if positions:
+                group_indexes.append([matrix_col, matrix_col + positions])
+                matrix_col += positions
+                positions = 0
         elif line.strip() == '':
             if position:
-                group.append(position)
-                position = []
+                positions += 1
+                position = 0
         else:
-            fixed = line.startswith('*')
-            if fixed:
+            is_fixed = line.startswith('*')
+            if is_fixed:
                 line = line[1:]
-            position.append([line.strip(), fixed])
+            persons.append(index_by_name.setdefault(line.strip(), len(index_by_name)))
+            cols.append(matrix_col + positions)
+            fixed.append(is_fixed)
+            position += 1
 
     if position:
-        group.append(position)
-    if group:
-        groups.append(group)
-
-    matrix_col = 0
-    group_indexes = []
-    for group in groups:
-        group_indexes.append([matrix_col, matrix_col + len(group)])
-        matrix_col += len(group)
-
-    names = list({name
-                  for group in groups
-                  for position in group
-                  for (name, _) in position})
-    names.sort()
-
+        positions += 1
+    if positions:
+        group_indexes.append([matrix_col, matrix_col + positions])
+
+    # Persons are numbered in name order
+    names_by_index = sorted(index_by_name, key=index_by_name.get)
+    order = sorted(range(len(names_by_index)), key=names_by_index.__getitem__)
+    names = [names_by_index[index] for index in order]
+    rank = numpy.empty(len(order), dtype=int)
+    rank[order] = numpy.arange(len(order))
+
+    rows = rank[persons]
     matrix = numpy.zeros((len(names), group_indexes[-1][1]), dtype=int)
-    fixed = numpy.zeros((len(names), group_indexes[-1][1]), dtype=bool)
-
-    persons_by_name = {name: idx for idx, name in enumerate(names)}
-    matrix_col = 0
-    for group in groups:
-        for position in group:
-            for name, is_fixed in position:
-                matrix_rox = persons_by_name[name]
-                matrix[matrix_rox, matrix_col] = 1
-                fixed[matrix_rox, matrix_col] = is_fixed
-            matrix_col += 1
+    matrix[rows, cols] = 1
+    fixed_matrix = numpy.zeros((len(names), group_indexes[-1][1]), dtype=bool)
+    fixed_matrix[rows, cols] = fixed
 
     geometry = matrix.copy().transpose()
 
@@ -78,25 +80,39 @@ def read_text(content):
                  group_indexes=group_indexes,
                  group_weights=group_weights,
                  seating=matrix,
-                 fixed=fixed,
+                 fixed=fixed_matrix,
                  geometry=geometry)
 
 
-def write_text(state):
+def write_text(state, out=None):
     """
+    Writes state table by table to out, or returns it as a string when out
+    is None.
+
+    @type state: state.State
+    """
+    if out is None:
+        result = StringIO()
+        write_text(state, result)
+        return result.getvalue()
+
+    for chunk in iter_text(state):
+        out.write(chunk)
+
+
+def iter_text(state):
+    """
+    The text form of state, one table at a time.
+
     @type state: state.State
     """
-    result = StringIO()
+    columns, persons = numpy.nonzero(state.seating.transpose() == 1)
+    bounds = numpy.searchsorted(columns, numpy.arange(state.seating.shape[1] + 1))
 
     for group_name, (i, j), weight in zip(state.group_names, state.group_indexes, state.group_weights):
         weight_str = (" (%d)" % weight) if weight > 1 else ''
-        result.write('# ' + group_name + weight_str + "\n\n")
+        yield '# ' + group_name + weight_str + "\n\n"
         for t in range(i, j):
-            for p in numpy.where(state.seating[:, t] == 1)[0]:
-                if state.fixed[p, t]:
-                    result.write('*')
-                result.write(state.names[p] + '\n')
-            result.write('\n')
-        result.write('\n')
-
-    return result.getvalue()
+            yield ''.join(('*' if state.fixed[p, t] else '') + state.names[p] + '\n'
+                          for p in persons[bounds[t]:bounds[t + 1]]) + '\n'
+        yield '\n'
@@ -0,0 +1,189 @@
+"""
+Compact binary form of State for the master/slave protocol.
+
+A state is sent as a small header followed by its seating as raw little
+endian bytes, optionally zlib compressed. Everything that does not change
+during a search (names, group names/indexes/weights, weights and fixed) is
+sent once as a static blob and referenced by its SHA-1 in the header.
+"""
+from collections import OrderedDict
+import hashlib
+import struct
+import zlib
+
+import numpy
+import simplejson
+
+from seating import State
+
+CONTENT_TYPE = 'application/x-seating-state'
+RESULT_CONTENT_TYPE = 'application/x-seating-result'
+
+MAGIC = 'SEAT'
+VERSION = 1
+COMPRESSED = 1
+
+_HEADER = struct.Struct('<4sBB20s')
+
+
+class UnknownStatic(Exception):
+    def __init__(self, static_id):
+        Exception.__init__(self, "Unknown static data %s" % static_id.encode('hex'))
+        self.static_id = static_id
+
+
+class StaticRegistry(object):
+    """
+    Static blobs by id, and the id of the static fields of the size most
+    recently seen states.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self._blobs = {}
+        self._fields = {}
+        self._ids = OrderedDict()
+
+    def register(self, state):
+        """
+        @type state: seating.State
+        """
+        fields = _static_fields(state)
+        key = tuple(id(field) for field in fields)
+        known = self._ids.pop(key, None)
+        if known is not None:
+            self._ids[key] = known
+            return known[0]
+        blob = encode_static(state)
+        static_id = hashlib.sha1(blob).digest()
+        self._blobs.setdefault(static_id, blob)
+        self._fields.setdefault(static_id, fields)
+        self._remember(key, static_id, fields)
+        return static_id
+
+    def add(self, blob):
+        static_id = hashlib.sha1(blob).digest()
+        if static_id not in self._fields:
+            fields = decode_static(blob)
+            self._blobs[static_id] = blob
+            self._fields[static_id] = fields
+            self._remember(tuple(id(field) for field in fields), static_id, fields)
+        return static_id
+
+    def _remember(self, key, static_id, fields):
+        # Keep the fields alive while they are remembered so their ids are not
+        # reused, but only for a few states: every state decoded from JSON has
+        # fields of its own.
+        self._ids[key] = (static_id, fields)
+        while len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+
+    def blob(self, static_id):
+        if static_id not in self._blobs:
+            raise UnknownStatic(static_id)
+        return self._blobs[static_id]
+
+    def fields(self, static_id):
+        if static_id not in self._fields:
+            raise UnknownStatic(static_id)
+        return self._fields[static_id]
+
+    def __contains__(self, static_id):
+        return static_id in self._fields
+
+
+def _static_fields(state):
+    return state.names, state.group_names, state.group_indexes, state.group_weights, state.weights, state.fixed
+
+
+def encode_static(state):
+    """
+    @type state: seating.State
+    """
+    header = simplejson.dumps({
+        "names": state.names,
+        "group_names": state.group_names,
+        "group_indexes": state.group_indexes,
+        "group_weights": state.group_weights,
+    })
+    result = [struct.pack('<I', len(header)), header]
+    _write_array(result, state.weights)
+    _write_array(result, state.fixed)
+    return zlib.compress(''.join(result), 1)
+
+
+def decode_static(blob):
+    data = zlib.decompress(blob)
+    size, = struct.unpack_from('<I', data)
+    values = simplejson.loads(data[4:4 + size])
+    weights, offset = _read_array(data, 4 + size)
+    fixed, offset = _read_array(data, offset)
+    return values['names'], values['group_names'], values['group_indexes'], values['group_weights'], weights, fixed
+
+
+def encode_state(state, registry, compress=True):
+    """
+    @type state: seating.State
+    @type registry: StaticRegistry
+    """
+    static_id = registry.register(state)
+    payload = []
+    _write_array(payload, state.seating.astype(numpy.uint8))
+    payload = ''.join(payload)
+    if compress:
+        payload = zlib.compress(payload, 1)
+    return _HEADER.pack(MAGIC, VERSION, COMPRESSED if compress else 0, static_id) + payload
+
+
+def static_id_of(data):
+    magic, version, _, static_id = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a seating state")
+    return static_id
+
+
+def decode_state(data, registry):
+    """
+    @type registry: StaticRegistry
+    """
+    magic, version, flags, static_id = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a seating state")
+    names, group_names, group_indexes, group_weights, weights, fixed = registry.fields(static_id)
+
+    payload = data[_HEADER.size:]
+    if flags & COMPRESSED:
+        payload = zlib.decompress(payload)
+    seating, _ = _read_array(payload, 0)
+    seating = seating.astype(int)
+
+    return State(names=names,
+                 group_names=group_names,
+                 group_indexes=group_indexes,
+                 group_weights=group_weights,
+                 seating=seating,
+                 weights=weights,
+                 fixed=fixed,
+                 geometry=seating.copy().transpose())
+
+
+def _write_array(out, array):
+    array = numpy.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+    dtype = array.dtype.str
+    out.append(struct.pack('<B', len(dtype)) + dtype)
+    out.append(struct.pack('<B', array.ndim) + struct.pack('<%dI' % array.ndim, *array.shape))
+    out.append(array.tobytes())
+
+
+def _read_array(data, offset):
+    size, = struct.unpack_from('<B', data, offset)
+    offset += 1
+    dtype = numpy.dtype(data[offset:offset + size])
+    offset += size
+    ndim, = struct.unpack_from('<B', data, offset)
+    offset += 1
+    shape = struct.unpack_from('<%dI' % ndim, data, offset)
+    offset += 4 * ndim
+    count = int(numpy.prod(shape))
+    array = numpy.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape).copy()
+    return array, offset + count * dtype.itemsize